@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for nmt's media I/O and rendering.
+
+    python benchmarks/bench.py [--sizes 320x240,1280x720] [--duration 5]
+                               [--only decode,encode,...] [-o results.json]
+                               [--compare baseline.json]
+
+Inputs are generated with ffmpeg's lavfi sources (testsrc & sine), so
+nothing needs downloading. Results go to JSON, along with enough about
+the machine to tell runs apart. The run fails if a parallel video2np
+differs from a serial decode of the same file; --compare reports each
+result against an earlier run, and fails if any got worse by more
+than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# ArrayUI ticks open (invisible) windows
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy as np
+import nmt
+from nmt import get_ffmpeg
+
+FPS = 30
+R = 44100
+
+RENDER_SCRIPT = '''
+import numpy as np
+shardable = True
+def video_out(a):
+    a[:] = (self.frame_idx * 3) % 256
+    a[:, ::2] = 255 - a[:, ::2]
+def audio_out(a):
+    a[:] = (np.random.random(a.shape) * 2000).astype(a.dtype)
+'''
+
+def _ffmpeg(*args):
+    subprocess.check_call([get_ffmpeg(), '-y', '-loglevel', 'error'] + list(args))
+
+def make_inputs(dirpath, sizes, duration):
+    "Synthetic test inputs: {'video': {size: path}, 'audio': path, 'image': {size: path}}"
+    inputs = {'video': {}, 'image': {}}
+    for (w, h) in sizes:
+        src = 'testsrc=size=%dx%d:rate=%d:duration=%s' % (w, h, FPS, duration)
+        path = os.path.join(dirpath, 'testsrc-%dx%d.mp4' % (w, h))
+        _ffmpeg('-f', 'lavfi', '-i', src, '-pix_fmt', 'yuv420p', path)
+        inputs['video'][(w, h)] = path
+
+        path = os.path.join(dirpath, 'testsrc-%dx%d.png' % (w, h))
+        _ffmpeg('-f', 'lavfi', '-i', src, '-frames:v', '1', path)
+        inputs['image'][(w, h)] = path
+
+    path = os.path.join(dirpath, 'sine.wav')
+    _ffmpeg('-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=%d:duration=%s' % (R, duration),
+            '-ac', '2', path)
+    inputs['audio'] = path
+    return inputs
+
+def _timed(f, *a, **kw):
+    t0 = time.perf_counter()
+    out = f(*a, **kw)
+    return out, time.perf_counter() - t0
+
+def _result(value, unit, higher_is_better=True):
+    return {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+def _size_name(size):
+    return '%dx%d' % size
+
+# Each bench_* yields (name, result) pairs
+
+def bench_decode(inputs, sizes, duration, tmpdir):
+    for size in sizes:
+        path = inputs['video'][size]
+
+        def count():
+            n = 0
+            for _fr in nmt.video_frames(path, width=size[0], height=size[1], fps=None, copy=False):
+                n += 1
+            return n
+        n, dt = _timed(count)
+        yield 'video_frames/%s' % _size_name(size), _result(n / dt, 'fps')
+
+        arr, dt = _timed(nmt.video2np, path, width=size[0], height=size[1], fps=None)
+        yield 'video2np/%s' % _size_name(size), _result(len(arr) / dt, 'fps')
+
+def bench_parallel(inputs, sizes, duration, tmpdir, workers=4):
+    # Segmented decoding must give exactly the serial decode's frames,
+    # including across a frame rate conversion (25 -> 30 fps here)
+    for (w, h) in sizes:
+        path = os.path.join(tmpdir, 'testsrc25-%dx%d.mp4' % (w, h))
+        _ffmpeg('-f', 'lavfi', '-i', 'testsrc=size=%dx%d:rate=25:duration=%s' % (w, h, duration),
+                '-pix_fmt', 'yuv420p', path)
+        serial = nmt.video2np(path, width=w, height=h, fps=FPS)
+        arr, dt = _timed(nmt.video2np, path, width=w, height=h, fps=FPS, workers=workers)
+        res = _result(len(arr) / dt, 'fps')
+        res['matches_serial'] = arr.shape == serial.shape and bool((arr == serial).all())
+        yield 'video2np[workers=%d]/%s' % (workers, _size_name((w, h))), res
+
+def bench_encode(inputs, sizes, duration, tmpdir):
+    for (w, h) in sizes:
+        nframes = int(duration * FPS)
+        frames = np.random.randint(0, 256, size=(8, h, w, 3)).astype(np.uint8)
+        out = os.path.join(tmpdir, 'encode-%dx%d.mp4' % (w, h))
+        _, dt = _timed(nmt.frames_to_video, (frames[i % 8] for i in range(nframes)), out, fps=FPS)
+        yield 'frames_to_video/%s' % _size_name((w, h)), _result(nframes / dt, 'fps')
+
+def bench_audio(inputs, sizes, duration, tmpdir):
+    def count():
+        n = 0
+        for ch in nmt.sound_chunks(inputs['audio'], R=R, nchannels=2):
+            n += len(ch)
+        return n
+    n, dt = _timed(count)
+    yield 'sound_chunks', _result(n / dt / R, 'x realtime')
+
+def bench_image(inputs, sizes, duration, tmpdir, repeat=20):
+    for size in sizes:
+        path = inputs['image'][size]
+        _, dt = _timed(lambda: [nmt.image2np(path) for _ in range(repeat)])
+        yield 'image2np/%s' % _size_name(size), _result(repeat / dt, 'images/s')
+
+def bench_render(inputs, sizes, duration, tmpdir):
+    script = os.path.join(tmpdir, 'render_script.py')
+    with open(script, 'w') as fh:
+        fh.write(RENDER_SCRIPT)
+    for size in sizes:
+        out = os.path.join(tmpdir, 'render-%s.mp4' % _size_name(size))
+        _, dt = _timed(nmt.render, script, out, duration, g={}, fps=FPS, R=R, size=size)
+        yield 'render/%s' % _size_name(size), _result(duration * FPS / dt, 'fps')
+
+def bench_tick(inputs, sizes, duration, tmpdir, nticks=200):
+    from nmt import mediate
+
+    class UI(mediate.ArrayUI):
+        def video_out(self, a):
+            a[:] = self.frame_idx % 256
+
+    for size in sizes:
+        ui = UI(size=size, fps=None)
+        ui.tick()                       # (first frame sets things up)
+        _, dt = _timed(lambda: [ui.tick() for _ in range(nticks)])
+        yield 'ArrayUI.tick/%s' % _size_name(size), _result(dt / nticks * 1000, 'ms', higher_is_better=False)
+
+BENCHES = {
+    'decode': bench_decode,
+    'parallel': bench_parallel,
+    'encode': bench_encode,
+    'audio': bench_audio,
+    'image': bench_image,
+    'render': bench_render,
+    'tick': bench_tick,
+}
+
+def machine_info():
+    try:
+        ffmpeg = subprocess.check_output([get_ffmpeg(), '-version']).decode('utf-8').split('\n')[0]
+    except (OSError, subprocess.CalledProcessError):
+        ffmpeg = None
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'ffmpeg': ffmpeg,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(results, baseline, tolerance):
+    "Print each result against `baseline'; returns the names of regressions."
+    worse = []
+    for name, res in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]['value']
+        ratio = res['value'] / old if old else float('inf')
+        if not res['higher_is_better']:
+            ratio = 1 / ratio if ratio else float('inf')
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  <-- regression'
+            worse.append(name)
+        print('%-28s %10.2f -> %10.2f %-10s (x%.2f)%s' % (
+            name, old, res['value'], res['unit'], ratio, flag))
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='320x240,640x480,1280x720',
+                        help='comma-separated WxH resolutions')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of input per benchmark')
+    parser.add_argument('--only', help='comma-separated subset of: %s' % (', '.join(BENCHES)))
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slow-down (fraction) that --compare counts as a regression')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(x) for x in s.split('x')) for s in args.sizes.split(',')]
+    names = args.only.split(',') if args.only else list(BENCHES)
+
+    tmpdir = tempfile.mkdtemp(prefix='nmt-bench-')
+    results = {}
+    try:
+        inputs = make_inputs(tmpdir, sizes, args.duration)
+        for name in names:
+            try:
+                for key, res in BENCHES[name](inputs, sizes, args.duration, tmpdir):
+                    results[key] = res
+                    print('%-28s %10.2f %s' % (key, res['value'], res['unit']))
+                    if res.get('matches_serial') is False:
+                        print('  -> differs from a serial decode')
+            except Exception as e:
+                # (eg. no display or audio libraries for `tick')
+                print('%-28s skipped: %s' % (name, e))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'machine': machine_info(), 'sizes': args.sizes,
+                       'duration': args.duration, 'results': results}, fh, indent=2)
+
+    if any(res.get('matches_serial') is False for res in results.values()):
+        return 1
+
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
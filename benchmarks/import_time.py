@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+How long `import nmt' takes, and what it drags in, each in a fresh
+interpreter:
+
+    python benchmarks/import_time.py [-n 10] [--json out.json]
+
+Exits non-zero if importing nmt (or using video2np) loads any of
+HEAVY, so that a stray top-level import doesn't go unnoticed.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['PIL', 'sdl2', 'watchdog', 'pyaudio']
+
+CASES = {
+    'import nmt': 'import nmt',
+    'nmt.video2np': 'import nmt; nmt.video2np',
+    'nmt.ArrayUI': 'import nmt; nmt.ArrayUI',
+}
+# cases that mustn't load HEAVY modules
+HEADLESS = ['import nmt', 'nmt.video2np']
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+%s
+dt = time.perf_counter() - t0
+heavy = [m for m in %r if m in sys.modules]
+print(json.dumps({"seconds": dt, "heavy": heavy}))
+'''
+
+def run_case(stmt, n):
+    times = []
+    heavy = []
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    for _ in range(n):
+        out = subprocess.run(
+            [sys.executable, '-c', PROBE % (stmt, HEAVY)],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        res = json.loads(out.stdout.decode('utf-8').strip().split('\n')[-1])
+        times.append(res['seconds'])
+        heavy = res['heavy']
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'heavy': heavy}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', type=int, default=10, help='runs per case')
+    parser.add_argument('--json', help='write results here')
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+    for name, stmt in CASES.items():
+        try:
+            results[name] = run_case(stmt, args.n)
+        except subprocess.CalledProcessError:
+            print('%-16s unavailable' % (name))
+            continue
+        r = results[name]
+        print('%-16s %7.1f ms  (min %.1f)  %s' % (
+            name, r['median_s'] * 1000, r['min_s'] * 1000, ' '.join(r['heavy'])))
+        if name in HEADLESS and r['heavy']:
+            print('  -> %s should not import %s' % (name, ', '.join(r['heavy'])))
+            failed = True
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'import_time': results}, fh, indent=2)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,7 @@ import numpy as np
 import nmt
 
 # On different systems, colororder may be rgb.
-arr = nmt.video2np(sys.argv[1], width=320, height=240, colororder='bgr')
+# (cache=True: only decode the first time around)
+arr = nmt.video2np(sys.argv[1], width=320, height=240, colororder='bgr', cache=True)
 
 nmt.run('slitscan.nmt.py', globals(), size=(320,240), name='slitscan')
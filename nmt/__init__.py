@@ -6,37 +6,68 @@ __all__ = (
     'media',
     'mediate',
     'remediate',
-    'get_ffmpeg'
+    'aio',
+    'get_ffmpeg',
+    'get_ffprobe'
 )
 
 FFMPEG = 'ffmpeg'               # system FFMpeg
 def get_ffmpeg():
     return FFMPEG
 
-from .media import (
-    video_info,
-    frame_reader,
-    video_frames,
-    webcam_reader,
-    webcam_frames,
-    video2np,
-    frame_writer,
-    frames_to_video,
-    np2video,
-    image2np,
-    np2image,
-    sound_chunks,
-    sound2np,
-    chunk_writer,
-    chunks_to_sound,
-    np2sound)
+FFPROBE = 'ffprobe'             # system FFProbe
+def get_ffprobe():
+    return FFPROBE
 
-try:
-    from .mediate import ArrayUI
-except ImportError:
-    logging.info("livecoding not available")
+# Submodules, and the names they export here, are only imported on
+# first use: `import nmt' stays cheap for headless scripts that
+# never touch PIL, SDL or watchdog.
+_exports = {
+    'probe': 'media',
+    'video_info': 'media',
+    'frame_reader': 'media',
+    'video_frames': 'media',
+    'prefetched': 'media',
+    'frame_index': 'media',
+    'frames_at': 'media',
+    'VideoReader': 'media',
+    'webcam_reader': 'media',
+    'webcam_frames': 'media',
+    'LatestFrame': 'media',
+    'LoopedFrames': 'media',
+    'video2np': 'media',
+    'frame_writer': 'media',
+    'frames_to_video': 'media',
+    'np2video': 'media',
+    'image2np': 'media',
+    'np2image': 'media',
+    'sound_chunks': 'media',
+    'sound2np': 'media',
+    'chunk_writer': 'media',
+    'chunks_to_sound': 'media',
+    'np2sound': 'media',
+    'av_writer': 'media',
+    'frames_and_chunks_to_video': 'media',
+    'ArrayUI': 'mediate',
+    'run': 'remediate',
+    'multi_run': 'remediate',
+    'render': 'remediate',
+}
 
-try:
-    from .remediate import run, multi_run, render
-except ImportError:
-    logging.info("recoding not available")
+def __getattr__(name):
+    import importlib
+    if name in ('media', 'mediate', 'remediate', 'aio'):
+        return importlib.import_module('.' + name, __name__)
+    if name not in _exports:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    try:
+        module = importlib.import_module('.' + _exports[name], __name__)
+    except ImportError as e:
+        logging.info("%s not available (%s)", name, e)
+        raise AttributeError(name) from e
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports) + list(__all__))
@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+
+# asyncio versions of the media.py readers & writers
+#
+#     async for fr in aio.video_frames(path, width=320):
+#         ...
+#
+#     w = await aio.frame_writer(320, 240, 'out.mp4')
+#     await w.write(fr)       # waits while ffmpeg's pipe is full
+#     await w.close()
+#
+# Everything runs on the event loop (no threads), so any number of
+# decodes and encodes can share one loop.
+
+import asyncio
+import numpy as np
+
+from . import get_ffmpeg
+from . import media
+
+
+async def probe(path, preamble=[], count_frames=False):
+    "See media.probe (and shares its memo)"
+    key = media._probe_key(path, count_frames)
+    probe = media._probe_lookup(key)
+    if probe is None:
+        p = await asyncio.create_subprocess_exec(
+            *media._probe_cmd(path, preamble, count_frames),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _stderr = await p.communicate()
+        if p.returncode != 0:
+            raise RuntimeError("ffprobe failed on %s" % (path))
+        probe = media._probe_store(key, stdout.decode("utf-8"))
+    return probe
+
+
+async def video_info(path, preamble=[]):
+    "See media.video_info"
+    try:
+        return media._probe_info(await probe(path, preamble=preamble))
+    except (OSError, RuntimeError):
+        # No ffprobe (or it doesn't understand the input): ask ffmpeg
+        pass
+
+    p = await asyncio.create_subprocess_exec(
+        *([get_ffmpeg()] + preamble + ["-i", path]),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _stdout, stderr = await p.communicate()
+    return media._video_info(stderr.decode("utf-8"))
+
+
+async def _spawn_reader(cmd):
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+
+
+async def _spawn_writer(cmd):
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+
+
+async def _kill(p):
+    if p.returncode is None:
+        p.kill()
+    await p.wait()
+
+
+async def video_frames(path, **kw):
+    """
+    Async generator of frames, shaped as media.video_frames's; takes
+    the same arguments as media.frame_reader.
+
+    Frames are read-only arrays over the bytes read from the pipe.
+    """
+    args = media._bind(media.frame_reader, path, **kw)
+    if args["width"] is None or args["height"] is None:
+        info = {}
+        if args["crop"] is None:
+            info = await video_info(path, preamble=args["preamble"])
+        args["width"], args["height"] = media._fit_size(
+            info, args["width"], args["height"], args["crop"]
+        )
+    width, height = args["width"], args["height"]
+    pix_fmt = media._reader_pix_fmt(**args)
+    shape = media._frame_shape(width, height, pix_fmt)
+
+    p = await _spawn_reader(media._frame_reader_cmd(**args))
+    try:
+        while True:
+            try:
+                buf = await p.stdout.readexactly(int(np.prod(shape)))
+            except asyncio.IncompleteReadError:
+                return
+            fr = np.frombuffer(buf, dtype=np.uint8).reshape(shape)
+            if pix_fmt == "yuv420p":
+                fr = media._planes(fr, width, height)
+            yield fr
+    finally:
+        await _kill(p)
+
+
+async def sound_chunks(path, chunksize=2048, **kw):
+    """
+    Async generator of (chunksize, nchannels) chunks; takes the same
+    arguments as media.sound_chunks. The last chunk may be short.
+    """
+    args = media._bind(media.chunk_reader, path, **kw)
+    nchannels = args["nchannels"]
+    np_dtype, _fmt = media.sample_format(args["dtype"])
+    frsize = np_dtype.itemsize * nchannels * chunksize
+
+    p = await _spawn_reader(media._chunk_reader_cmd(**args))
+    try:
+        while True:
+            try:
+                buf = await p.stdout.readexactly(frsize)
+            except asyncio.IncompleteReadError as e:
+                buf = e.partial
+            yield np.frombuffer(buf, dtype=np_dtype).reshape((-1, nchannels))
+            if len(buf) < frsize:
+                return
+    finally:
+        await _kill(p)
+
+
+class Writer(object):
+    "Feeds arrays to an ffmpeg's stdin"
+
+    def __init__(self, p):
+        self._p = p
+
+    async def write(self, arr):
+        # Queue the array's bytes, then wait until ffmpeg has caught up
+        # enough for the pipe buffer to drain.
+        media._write_array(self._p.stdin, arr)
+        await self._p.stdin.drain()
+
+    async def close(self):
+        self._p.stdin.close()
+        await self._p.wait()
+        return self._p.returncode
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *a):
+        await self.close()
+
+
+async def frame_writer(width, height, path, **kw):
+    args = media._bind(media.frame_writer, width, height, path, **kw)
+    return Writer(await _spawn_writer(media._frame_writer_cmd(**args)))
+
+
+async def chunk_writer(nchannels, path, **kw):
+    args = media._bind(media.chunk_writer, nchannels, path, **kw)
+    return Writer(await _spawn_writer(media._chunk_writer_cmd(**args)))
+
+
+async def frames_to_video(frames, *a, **kw):
+    "`frames' may be an async or a regular iterable"
+    w = None
+    async for fr in _aiter(frames):
+        if w is None:
+            width, height = media._frame_size(fr, kw.get("pix_fmt", "rgb24"))
+            w = await frame_writer(width, height, *a, **kw)
+        await w.write(fr)
+    if w is not None:
+        await w.close()
+
+
+async def chunks_to_sound(chunks, *a, **kw):
+    "`chunks' may be an async or a regular iterable"
+    w = None
+    async for ch in _aiter(chunks):
+        if w is None:
+            nchannels = ch.shape[1] if len(ch.shape) > 1 else 1
+            kw.setdefault("dtype", ch.dtype)
+            w = await chunk_writer(nchannels, *a, **kw)
+        await w.write(ch)
+    if w is not None:
+        await w.close()
+
+
+async def _aiter(it):
+    if hasattr(it, "__aiter__"):
+        async for x in it:
+            yield x
+    else:
+        for x in it:
+            yield x
@@ -1,13 +1,29 @@
-from PIL import Image
 import numpy as np
 import subprocess
+import bisect
+import collections
+import fractions
+import hashlib
+import inspect
+import itertools
+import json
+import math
+import os
+import queue
 import re
 import sys
+import tempfile
+import threading
+import time
 
-from . import get_ffmpeg# = "ffmpeg"
+from . import get_ffmpeg, get_ffprobe
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nmt')
+CACHE_BYTES = 10 * 2**30        # evict least-recently-used past this size
 
 def image2np(path):
     "Load an image file into an array."
+    from PIL import Image               # (slow to import; only if needed)
 
     im = Image.open(path)
 
@@ -41,6 +57,7 @@ def image2np(path):
 
 def np2image(np, path):
     "Save an image array to a file."
+    from PIL import Image
     if len(np.shape) > 2:
         if np.shape[2] == 3:
             mode = 'RGB'
@@ -109,20 +126,201 @@ def _video_info(stderr):
 
     return out
 
+Stream = collections.namedtuple('Stream', [
+    'index', 'codec_type', 'codec_name', 'time_base', 'start', 'duration',
+    'nb_frames',
+    # video
+    'width', 'height', 'pix_fmt', 'fps', 'rotation',
+    # audio
+    'sample_rate', 'channels', 'sample_fmt'])
+
+class Probe(collections.namedtuple('Probe', [
+        'format_name', 'duration', 'start', 'bit_rate', 'tags', 'streams'])):
+    "Result of probe(); fps and time_base are Fractions"
+
+    @property
+    def video(self):
+        "The first video stream (or None)"
+        return self._first('video')
+
+    @property
+    def audio(self):
+        "The first audio stream (or None)"
+        return self._first('audio')
+
+    def _first(self, codec_type):
+        for st in self.streams:
+            if st.codec_type == codec_type:
+                return st
+        return None
+
+_probes = {}                    # (abspath, size, mtime, count_frames) -> Probe
+
+def _probe_key(path, count_frames):
+    # None if `path' isn't a plain file (eg. a webcam)
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime, count_frames)
+
+def _probe_cache_path(key):
+    return os.path.join(CACHE_DIR, 'probe', hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.json')
+
+def _probe_cmd(path, preamble, count_frames):
+    return [get_ffprobe(), '-v', 'error',
+            '-print_format', 'json',
+            '-show_format', '-show_streams'] + (
+            ['-count_frames'] if count_frames else []) + preamble + [
+            path]
+
+def _probe_lookup(key):
+    # In-process, then on-disk memo; None if we haven't seen `key'.
+    if key is None:
+        return None
+    if key not in _probes:
+        try:
+            with open(_probe_cache_path(key)) as fh:
+                _probes[key] = _parse_probe(fh.read())
+        except (IOError, ValueError):
+            return None
+    return _probes[key]
+
+def _probe_store(key, out):
+    probe = _parse_probe(out)
+    if key is not None:
+        _probes[key] = probe
+        try:
+            cache_path = _probe_cache_path(key)
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_path))
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(out)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            # An unwritable cache shouldn't stop anyone from probing
+            pass
+    return probe
+
+def probe(path, preamble=[], count_frames=False):
+    """
+    Describe a media file with ffprobe.
+
+    Results are memoized in-process and on disk (under CACHE_DIR),
+    keyed on the file's path, size and mtime, so re-opening the same
+    file costs a stat(). With count_frames=True, nb_frames is an exact
+    count (which means decoding the whole file, once).
+    """
+    key = _probe_key(path, count_frames)
+    probe = _probe_lookup(key)
+    if probe is None:
+        out = subprocess.check_output(_probe_cmd(path, preamble, count_frames),
+                                      stderr=open('/dev/null', 'w'))
+        probe = _probe_store(key, out.decode('utf-8'))
+    return probe
+
+def _parse_probe(out):
+    def num(x, kind=float):
+        try:
+            return kind(x)
+        except (TypeError, ValueError, ZeroDivisionError):
+            return None
+
+    def rational(x):
+        r = num(x, fractions.Fraction)
+        # ffprobe says 0/0 for "unknown"
+        return r if r else None
+
+    raw = json.loads(out)
+    streams = []
+    for st in raw.get('streams', []):
+        rotation = None
+        for side_data in st.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = num(side_data['rotation'])
+        if rotation is None and 'rotate' in st.get('tags', {}):
+            # older ffmpeg
+            rotation = -num(st['tags']['rotate'])
+
+        streams.append(Stream(
+            index=st.get('index'),
+            codec_type=st.get('codec_type'),
+            codec_name=st.get('codec_name'),
+            time_base=rational(st.get('time_base')),
+            start=num(st.get('start_time')),
+            duration=num(st.get('duration')),
+            nb_frames=num(st.get('nb_read_frames', st.get('nb_frames')), int),
+            width=st.get('width'),
+            height=st.get('height'),
+            pix_fmt=st.get('pix_fmt'),
+            fps=rational(st.get('avg_frame_rate')) or rational(st.get('r_frame_rate')),
+            rotation=rotation,
+            sample_rate=num(st.get('sample_rate'), int),
+            channels=st.get('channels'),
+            sample_fmt=st.get('sample_fmt')))
+
+    fmt = raw.get('format', {})
+    return Probe(
+        format_name=fmt.get('format_name'),
+        duration=num(fmt.get('duration')),
+        start=num(fmt.get('start_time')),
+        bit_rate=num(fmt.get('bit_rate'), int),
+        tags=fmt.get('tags', {}),
+        streams=streams)
+
+def _probe_info(probe):
+    # The video_info() dict, from a Probe
+    out = {"duration": probe.duration}
+    if probe.start is not None:
+        out["start"] = probe.start
+    if 'creation_time' in probe.tags:
+        out["creation_time"] = probe.tags['creation_time']
+
+    audio = probe.audio
+    if audio is not None:
+        out["audiorate"] = audio.sample_rate
+        out["nchannels"] = audio.channels
+
+    video = probe.video
+    if video is not None:
+        out["width"] = video.width
+        out["height"] = video.height
+        if video.fps is not None:
+            out["fps"] = float(video.fps)
+        if video.rotation is not None:
+            out["rotation"] = video.rotation
+
+    return out
+
 def video_info(path, preamble=[]):
+    try:
+        return _probe_info(probe(path, preamble=preamble))
+    except (OSError, subprocess.CalledProcessError):
+        # No ffprobe (or it doesn't understand the input): ask ffmpeg
+        pass
+
     cmd = [get_ffmpeg()] + preamble + ['-i', path]
     p = subprocess.Popen(cmd, stderr=subprocess.PIPE)
     stdout, stderr = p.communicate()
 
     return _video_info(stderr.decode('utf-8'))
 
-def _infer_size(path, width, height, preamble=[]):
+def _infer_size(path, width, height, preamble=[], crop=None):
+    if width is None or height is None:
+        info = {} if crop else video_info(path, preamble=preamble)
+        width, height = _fit_size(info, width, height, crop)
+    return (width, height)
+
+def _fit_size(info, width, height, crop=None):
+    # fill in a missing width and/or height from the aspect ratio
+    # (of the cropped region, if there's a crop)
     def div4(i):
         return 4*int(i/4.0)
 
+    if crop is not None:
+        info = dict(info, width=crop[2], height=crop[3])
+
     if width is None or height is None:
-        # compute aspect ratio
-        info = video_info(path, preamble=preamble)
         if width is None and height is None:
             width = info["width"]
             height = info["height"]
@@ -133,25 +331,46 @@ def _infer_size(path, width, height, preamble=[]):
 
     return (width, height)
 
-def frame_reader(path, height=None, width=None, start=0, fps=30, duration=None, colororder='rgb', bitrate='24', preamble=[]):
+def frame_reader(path, height=None, width=None, start=0, fps=30, duration=None, colororder='rgb', bitrate='24', preamble=[], ffopts=[], pix_fmt=None, crop=None):
     # low-level ffmpeg wrapper
-    width, height = _infer_size(path, width, height, preamble=preamble)
+    # (fps=None keeps the native frame rate)
+    #
+    # pix_fmt (default: colororder+bitrate, eg. rgb24) may also be
+    # 'gray', 'rgba'/'bgra' or planar 'yuv420p' -- see _frame_shape.
+    # crop=(x, y, w, h) cuts out a region of the source (in its own
+    # pixels) before scaling; width & height default to the region's.
+    width, height = _infer_size(path, width, height, preamble=preamble, crop=crop)
+    cmd = _frame_reader_cmd(path, height, width, start, fps, duration, colororder, bitrate, preamble, ffopts, pix_fmt, crop)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
+    return (width, height, p)
+
+def _reader_pix_fmt(colororder='rgb', bitrate='24', pix_fmt=None, **_kw):
+    return pix_fmt or '%s%s' % (colororder, bitrate)
+
+def _frame_reader_cmd(path, height, width, start, fps, duration, colororder, bitrate, preamble, ffopts, pix_fmt=None, crop=None, select=None):
+    filters = 'scale=%d:%d' % (width, height)
+    if crop is not None:
+        filters = 'crop=%d:%d:%d:%d,' % (crop[2], crop[3], crop[0], crop[1]) + filters
+    if select is not None:
+        filters = "select='%s'," % (select) + filters
 
     dur_opts = []
     if duration is not None:
         dur_opts = ['-t', str(duration)]
 
+    fps_opts = []
+    if fps is not None:
+        fps_opts = ['-r', str(fps)]
+
     cmd = [get_ffmpeg()] + preamble + [
            '-ss', "%f" % (start),
            '-i', path] + dur_opts + [
-           '-vf', 'scale=%d:%d'%(width,height),
-           '-r', str(fps),
+           '-vf', filters] + fps_opts + [
            '-an',
            '-vcodec', 'rawvideo', '-f', 'rawvideo',
-           '-pix_fmt', '%s%s' % (colororder, bitrate),
+           '-pix_fmt', _reader_pix_fmt(colororder, bitrate, pix_fmt)] + ffopts + [
            '-']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
-    return (width, height, p)
+    return cmd
 
 def webcam_reader(name="", preamble=[], **kw):
     # https://trac.ffmpeg.org/wiki/Capture/Webcam
@@ -161,62 +380,923 @@ def webcam_reader(name="", preamble=[], **kw):
     elif "linux" in sys.platform:
         return frame_reader(name, preamble=["-f", "v4l2"]+preamble, **kw)
 
-def video_frames(path, **kw):
-    width, height, p = frame_reader(path, **kw)
+def _readinto(fh, buf):
+    # Fill `buf' from a pipe, looping over short reads. Returns the
+    # number of bytes read, which is only short of len(buf) at EOF.
+    mv = memoryview(buf).cast('B')
+    nread = 0
+    while nread < len(mv):
+        n = fh.readinto(mv[nread:])
+        if not n:
+            break
+        nread += n
+    return nread
 
-    while True:
-        arr = np.fromstring(p.stdout.read(width*height*3), dtype=np.uint8)
-        if len(arr) == 0:
-            p.wait()
-            return
+# channels per pixel of the packed formats frame_reader can shape
+# (None: a 2-d, single-channel frame)
+_PIX_FMTS = {
+    'rgb24': 3, 'bgr24': 3,
+    'rgba': 4, 'bgra': 4, 'argb': 4, 'abgr': 4,
+    'gray': None,
+}
+
+def _frame_shape(width, height, pix_fmt):
+    # The shape of a raw frame; yuv420p frames are read flat, and then
+    # split by _planes
+    if pix_fmt == 'yuv420p':
+        if width % 2 or height % 2:
+            raise ValueError('yuv420p needs an even width and height')
+        return (width * height * 3 // 2,)
+    if pix_fmt not in _PIX_FMTS:
+        raise ValueError('unsupported pix_fmt %r' % (pix_fmt))
+    if _PIX_FMTS[pix_fmt] is None:
+        return (height, width)
+    return (height, width, _PIX_FMTS[pix_fmt])
+
+def _planes(buf, width, height):
+    # (Y, U, V) views of a flat yuv420p frame
+    n = width * height
+    return (buf[:n].reshape((height, width)),
+            buf[n:n * 5 // 4].reshape((height // 2, width // 2)),
+            buf[n * 5 // 4:].reshape((height // 2, width // 2)))
+
+def _shaped_frames(p, width, height, pix_fmt, copy=True, nbuffers=2):
+    # _raw_frames, shaped for pix_fmt
+    frames = _raw_frames(p, _frame_shape(width, height, pix_fmt), copy=copy, nbuffers=nbuffers)
+    if pix_fmt != 'yuv420p':
+        return frames
+    return (_planes(fr, width, height) for fr in frames)
+
+def _raw_frames(p, shape, dtype=np.uint8, copy=True, nbuffers=2):
+    """
+    Read fixed-size frames from the stdout of an ffmpeg process.
 
-        yield arr.reshape((height, width, 3))
+    With copy=True, each frame is a new array owned by the caller.
+
+    With copy=False, frames are read into a ring of `nbuffers'
+    preallocated arrays, and the yielded array is a view that is only
+    valid until the next call to next(); copy it if you need to keep
+    it around.
+
+    A truncated final frame is dropped.
+    """
+    if copy:
+        pool = None
+    else:
+        pool = [np.empty(shape, dtype=dtype) for _ in range(max(1, nbuffers))]
+
+    idx = 0
+    try:
+        while True:
+            if pool is None:
+                arr = np.empty(shape, dtype=dtype)
+            else:
+                arr = pool[idx % len(pool)]
+                idx += 1
+
+            if _readinto(p.stdout, arr) < arr.nbytes:
+                p.wait()
+                return
+
+            yield arr
+    finally:
+        # Closed (or garbage-collected) before EOF
+        _kill(p)
+
+def _kill(p):
+    # Stop an ffmpeg whose output we don't want any more
+    if p.poll() is None:
+        p.kill()
+    p.wait()
+
+class _PrefetchError(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+_PREFETCH_DONE = object()
+
+def prefetched(generator, k=4):
+    """
+    Run `generator' on a background thread, up to `k' items ahead of
+    the consumer, so that reading from ffmpeg overlaps with whatever
+    the consumer does with each item.
+
+    Closing (or garbage-collecting) the returned generator stops the
+    thread, which closes `generator' (and so kills its ffmpeg).
+    """
+    q = queue.Queue(maxsize=k)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in generator:
+                if not put(item):
+                    break
+        except Exception as e:
+            put(_PrefetchError(e))
+        finally:
+            generator.close()
+            put(_PREFETCH_DONE)
+
+    t = threading.Thread(target=work)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+def video_frames(path, copy=True, nbuffers=2, prefetch=None, **kw):
+    # prefetch=k reads up to k frames ahead on a background thread
+    if prefetch:
+        # The ring must outlast the queue, plus the frames held by the
+        # reader thread and by the consumer.
+        nbuffers = max(nbuffers, prefetch + 2)
+        return prefetched(_video_frames(path, copy, nbuffers, **kw), prefetch)
+    return _video_frames(path, copy, nbuffers, **kw)
+
+def _video_frames(path, copy, nbuffers, **kw):
+    # (height, width, 3) frames by default; (height, width, 4) for
+    # pix_fmt='rgba' etc., (height, width) for 'gray', and (Y, U, V)
+    # tuples of planes for 'yuv420p'
+    width, height, p = frame_reader(path, **kw)
+    for fr in _shaped_frames(p, width, height, _reader_pix_fmt(**kw), copy=copy, nbuffers=nbuffers):
+        yield fr
 
 def webcam_frames(*a, **kw):
     # Returns a never-ending generator of webcam frames
-    # XXX: duplicated code with video_frames
+    # (see _raw_frames for `copy' & `nbuffers')
+    copy = kw.pop('copy', True)
+    nbuffers = kw.pop('nbuffers', 2)
     width, height, p = webcam_reader(*a, **kw)
+    for fr in _shaped_frames(p, width, height, _reader_pix_fmt(**kw), copy=copy, nbuffers=nbuffers):
+        yield fr
+
+class LatestFrame(object):
+    """
+    Read frames from an ffmpeg process (eg. a webcam_reader) on a
+    background thread, keeping only the newest.
+
+        cap = LatestFrame(p, (height, width, 3))
+        fr = cap.get()      # the newest frame, without waiting for it
+
+    Frames go into three preallocated buffers, which rotate between the
+    reader (filling one), the newest complete frame, and the frame that
+    get() last returned -- which stays valid until the next get().
+
+    cap.timestamp is when the last frame returned by get() was
+    captured (time.perf_counter()), cap.captured counts frames read,
+    and cap.dropped those that were overwritten before anyone got them.
+    """
+
+    def __init__(self, p, shape, dtype=np.uint8):
+        self._p = p
+        self._bufs = [np.empty(shape, dtype=dtype) for _ in range(3)]
+        self._back = 0          # being filled by the reader
+        self._ready = None      # newest complete frame
+        self._front = None      # handed out by get()
+        self._ready_timestamp = None
+        self._cond = threading.Condition()
+
+        self.timestamp = None
+        self.captured = 0
+        self.dropped = 0
+        self.eof = False
+
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            buf = self._bufs[self._back]
+            if _readinto(self._p.stdout, buf) < buf.nbytes:
+                with self._cond:
+                    self.eof = True
+                    self._cond.notify_all()
+                return
+            timestamp = time.perf_counter()
+
+            with self._cond:
+                if self._ready is not None:
+                    self.dropped += 1
+                self._ready = self._back
+                self._back = ({0, 1, 2} - {self._ready, self._front}).pop()
+                self._ready_timestamp = timestamp
+                self.captured += 1
+                self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Return the newest frame, which is the same as last time if no
+        new one has come in. Only waits (for up to `timeout' seconds)
+        for the very first frame; returns None if there isn't one.
+        """
+        with self._cond:
+            if self._front is None and self._ready is None and not self.eof:
+                self._cond.wait(timeout)
+            if self._ready is not None:
+                self._front, self._ready = self._ready, None
+                self.timestamp = self._ready_timestamp
+            if self._front is None:
+                return None
+            return self._bufs[self._front]
+
+    def close(self):
+        _kill(self._p)
+        self._thread.join()
+
+class LoopedFrames(object):
+    """
+    A stand-in for LatestFrame that plays an (nframes, height, width,
+    3) array -- eg. from video2np -- on a loop, at `fps' frames per
+    second of wall-clock time:
+
+        cap = LoopedFrames(video2np(path, fps=30, cache=True), fps=30)
+
+    With fps=None, each get() simply steps to the next frame.
+    """
+
+    def __init__(self, frames, fps=30):
+        if len(frames) == 0:
+            raise ValueError('no frames to loop')
+        self.frames = frames
+        self.fps = fps
+        self._start = time.perf_counter()
+        self._idx = -1
+
+        self.timestamp = None
+        self.captured = 0
+        self.dropped = 0
+        self.eof = False
+
+    def get(self, timeout=None):
+        now = time.perf_counter()
+        if self.fps is None:
+            idx = self._idx + 1
+        else:
+            idx = int((now - self._start) * self.fps)
+        if idx != self._idx:
+            self.dropped += max(0, idx - self._idx - 1)
+            self.captured += 1
+            self.timestamp = now
+            self._idx = idx
+        return self.frames[idx % len(self.frames)]
+
+    def close(self):
+        pass
+
+def _bind(f, *a, **kw):
+    # f's arguments by name, defaults filled in
+    args = inspect.signature(f).bind(*a, **kw)
+    args.apply_defaults()
+    return dict(args.arguments)
+
+def _reader_args(path, **kw):
+    return _bind(frame_reader, path, **kw)
+
+def _cache_key(path, extra=(), **kw):
+    # Everything that determines the decoded array
+    args = _reader_args(path, **kw)
+    st = os.stat(path)
+    args.update(path=os.path.abspath(path), mtime=st.st_mtime, size=st.st_size)
+    return hashlib.sha1(repr((sorted(args.items()), extra)).encode('utf-8')).hexdigest()
+
+def _cache_evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy') and name != keep:
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+
+    total = sum([size for (_mtime, size, _name) in entries])
+    if keep is not None:
+        total += os.path.getsize(os.path.join(cache_dir, keep))
+    while entries and total > max_bytes:
+        _mtime, size, name = entries.pop(0)
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        total -= size
+
+def video2np(path, cache=None, cache_bytes=None, workers=None, max_bytes=None, fit=None, **kw):
+    """
+    Decode a video into an (nframes, height, width, 3) array.
+
+    The array is allocated up front, from the probed duration, and only
+    grows (geometrically) if that estimate turns out to be short.
+
+    With max_bytes, a video that won't fit is caught before decoding
+    starts: fit='fps' lowers the frame rate and fit='size' the frame
+    size until it does; otherwise a MemoryError is raised.
+
+    With cache=True (or a directory), the decoded array is kept in an
+    on-disk .npy cache (default: CACHE_DIR) keyed on the file's path,
+    size & mtime and the decoding options, and returned as a
+    copy-on-write np.memmap. The cache is trimmed to `cache_bytes'
+    (default: CACHE_BYTES), evicting the least recently used entries.
+
+    With workers=N, the duration is split into N ranges that are
+    decoded concurrently, each by its own ffmpeg, straight into one
+    preallocated array.
+    """
+    if not cache:
+        return _video2np(path, workers, max_bytes, fit, **kw)
+
+    cache_dir = CACHE_DIR if cache is True else cache
+    if cache_bytes is None:
+        cache_bytes = CACHE_BYTES
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    npy_path = os.path.join(cache_dir, _cache_key(path, (max_bytes, fit), **kw) + '.npy')
+    if os.path.exists(npy_path):
+        os.utime(npy_path, None)         # LRU bookkeeping
+    else:
+        arr = _video2np(path, workers, max_bytes, fit, **kw)
+        # Write under a temporary name so that concurrent readers never
+        # see a partial file.
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            np.save(fh, arr)
+        os.rename(tmp_path, npy_path)
+        _cache_evict(cache_dir, cache_bytes, keep=os.path.basename(npy_path))
+
+    return np.load(npy_path, mmap_mode='c')
+
+def _video2np(path, workers, max_bytes, fit, **kw):
+    args = _reader_args(path, **kw)
+    del args['path']
+
+    pix_fmt = _reader_pix_fmt(**args)
+    if pix_fmt == 'yuv420p':
+        raise ValueError('video2np needs a packed pix_fmt (not yuv420p)')
+    info = video_info(path, preamble=args['preamble'])
+    args['width'], args['height'] = _fit_size(info, args['width'], args['height'], args['crop'])
+    fps = args['fps'] or info.get('fps')
+    duration = args['duration']
+    if duration is None and info['duration'] is not None:
+        duration = info['duration'] - args['start']
+
+    nframes = None
+    if fps is not None and duration is not None:
+        nframes = int(duration * fps)
+
+    if max_bytes is not None and nframes is not None:
+        new_fps, nframes = _fit_budget(args, fps, duration, nframes, max_bytes, fit)
+        if new_fps != fps:
+            args['fps'] = fps = new_fps
+    frame_shape = _frame_shape(args['width'], args['height'], pix_fmt)
+
+    if workers is not None and workers > 1 and nframes is not None:
+        args['fps'] = fps
+        return _parallel_video2np(path, workers, nframes, **args)
+
+    _w, _h, p = frame_reader(path, **args)
+    out = np.empty(((nframes or 0) + 1,) + frame_shape, dtype=np.uint8)
+    return _read_growing(p, out, max_bytes)
+
+def _fit_budget(args, fps, duration, nframes, max_bytes, fit):
+    # Returns (fps, nframes), after adjusting args for the budget
+    def frame_bytes():
+        return int(np.prod(_frame_shape(args['width'], args['height'], _reader_pix_fmt(**args))))
+
+    def nbytes():
+        return nframes * frame_bytes()
+
+    if nbytes() <= max_bytes:
+        return (fps, nframes)
+
+    if fit == 'fps':
+        max_frames = max_bytes // frame_bytes()
+        fps = max(max_frames - 1, 0) / float(duration)
+        nframes = int(duration * fps)
+    elif fit == 'size':
+        scale = (max_bytes / float(nbytes())) ** 0.5
+        args['width'] = 2 * int(args['width'] * scale / 2)
+        args['height'] = 2 * int(args['height'] * scale / 2)
+
+    if nframes == 0 or args['width'] == 0 or args['height'] == 0 or nbytes() > max_bytes:
+        raise MemoryError("video would need %d bytes (max_bytes=%d)" % (nbytes(), max_bytes))
+    return (fps, nframes)
+
+def _read_growing(p, out, max_bytes=None):
+    """
+    Read p's stdout into `out' along its first axis, growing `out'
+    geometrically (but never past max_bytes) if it's too small. Returns
+    `out', trimmed to what was read.
+    """
+    rowbytes = out[0].nbytes
+    n = 0
+    try:
+        while True:
+            if n < len(out):
+                n += _readinto(p.stdout, out[n:]) // rowbytes
+                if n < len(out):
+                    break       # EOF
+            if not p.stdout.peek(1):
+                break           # EOF, exactly at capacity
+
+            size = 2 * len(out)
+            if max_bytes is not None:
+                size = min(size, max_bytes // rowbytes)
+            if size <= len(out):
+                raise MemoryError("decoded data exceeds max_bytes=%d" % (max_bytes))
+            # (resize re-uses the allocation where it can)
+            out.resize((size,) + out.shape[1:], refcheck=False)
+        p.wait()
+    finally:
+        _kill(p)
 
-    while True:
-        arr = np.fromstring(p.stdout.read(width*height*3), dtype=np.uint8)
-        if len(arr) == 0:
-            p.wait()
+    out.resize((n,) + out.shape[1:], refcheck=False)
+    return out
+
+def _parallel_video2np(path, workers, nframes, start, duration, **args):
+    fps = args['fps']
+    out = np.empty((nframes,) + _frame_shape(args['width'], args['height'], _reader_pix_fmt(**args)), dtype=np.uint8)
+
+    # Seeking to a segment's first output frame would drop the source
+    # frame just before it, which the serial frame rate conversion may
+    # well have shown there. So start a source frame's worth of output
+    # frames early (keeping to the serial decode's grid of output
+    # frames), and drop those.
+    src_fps = video_info(path, preamble=args['preamble']).get('fps')
+    lead = int(math.ceil(fps / float(src_fps))) if src_fps else 1
+
+    def spawn(offset, count):
+        skip = min(lead, offset)
+        # One frame extra, so that rounding can't leave a gap
+        _w, _h, p = frame_reader(path, start=start + (offset - skip) / float(fps),
+                                 duration=(count + skip + 1) / float(fps), **args)
+        if skip:
+            _readinto(p.stdout, np.empty((skip,) + out.shape[1:], dtype=out.dtype))
+        return p
+
+    return _parallel_read(out, _segments(nframes, workers), spawn)
+
+def _segments(total, workers):
+    # Split range(total) into `workers' (offset, count) pieces
+    bounds = [int(round(idx * total / float(workers))) for idx in range(workers + 1)]
+    return [(a, b - a) for (a, b) in zip(bounds[:-1], bounds[1:]) if b > a]
+
+def _parallel_read(out, segments, spawn):
+    """
+    Fill `out' segment by segment, concurrently, from ffmpeg processes.
+
+    `segments' is a list of (offset, count) slices along the first axis
+    of `out', and spawn(offset, count) starts a process that writes
+    (at least) that slice to its stdout. Each process gets a thread
+    that reads it straight into its slice of `out'.
+
+    If any segment comes up short, the gaps are closed up (which
+    costs a copy).
+    """
+    counts = [0] * len(segments)
+    errors = []
+
+    def work(seg_idx):
+        offset, count = segments[seg_idx]
+        try:
+            p = spawn(offset, count)
+        except Exception as e:
+            errors.append(e)
             return
+        try:
+            dest = out[offset:offset+count]
+            counts[seg_idx] = _readinto(p.stdout, dest) // dest[0].nbytes
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # We read only what we asked for
+            p.stdout.close()
+            _kill(p)
+
+    threads = [threading.Thread(target=work, args=(seg_idx,))
+               for seg_idx in range(len(segments))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    if all([n == count for (n, (_offset, count)) in zip(counts, segments)]):
+        return out
+    return np.concatenate([out[offset:offset+n] for (n, (offset, _count)) in zip(counts, segments)])
+
+_frame_indices = {}             # (abspath, size, mtime) -> (times, keyframes, first_pts)
+
+def frame_index(path):
+    """
+    Return (times, keyframes) for the first video stream of `path':
+    the sorted presentation time of every frame (in seconds from the
+    first frame) and the indices of the frames that are keyframes.
+
+    The index comes from a single ffprobe packet scan (no decoding),
+    and is memoized in-process and on disk (under CACHE_DIR) for as
+    long as the file's size and mtime don't change.
+    """
+    times, keyframes, _first_pts = _frame_index(path)
+    return (times, keyframes)
+
+def _frame_index(path):
+    # frame_index(), plus the first frame's own presentation time
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _frame_indices:
+        index = _frame_index_load(key)
+        if index is None:
+            index = _frame_index_scan(path)
+            _frame_index_store(key, index)
+        _frame_indices[key] = index
+    return _frame_indices[key]
+
+_FRAME_INDEX_VERSION = 2        # bump when the index's contents change
+
+def _frame_index_cache_path(key):
+    key = (_FRAME_INDEX_VERSION,) + key
+    return os.path.join(CACHE_DIR, 'index', hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npz')
+
+def _frame_index_load(key):
+    try:
+        with np.load(_frame_index_cache_path(key)) as npz:
+            return (npz['times'], [int(k) for k in npz['keyframes']], float(npz['first_pts']))
+    except (IOError, ValueError, KeyError):
+        return None
+
+def _frame_index_store(key, index):
+    times, keyframes, first_pts = index
+    try:
+        cache_path = _frame_index_cache_path(key)
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, times=times, keyframes=np.array(keyframes, dtype=np.int64),
+                     first_pts=first_pts)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # An unwritable cache shouldn't stop anyone from indexing
+        pass
+
+def _frame_index_scan(path):
+    cmd = [get_ffprobe(), '-v', 'error',
+           '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags',
+           '-of', 'csv=p=0',
+           path]
+    out = subprocess.check_output(cmd).decode('utf-8')
+
+    packets = []
+    for line in out.split('\n'):
+        fields = line.strip().split(',')
+        if len(fields) < 2:
+            continue
+        if 'D' in fields[1]:
+            # discarded packets never come out of the decoder
+            continue
+        try:
+            packets.append((float(fields[0]), 'K' in fields[1]))
+        except ValueError:
+            # pts_time=N/A
+            continue
+    packets.sort()
+
+    times = np.array([t for t, _ in packets], dtype=np.float64)
+    first_pts = 0.0
+    if len(times):
+        first_pts = float(times[0])
+        times -= first_pts
+    keyframes = [idx for idx, (_, key_p) in enumerate(packets) if key_p]
+    return (times, keyframes, first_pts)
+
+def frames_at(path, times, height=None, width=None, index=False, keyframes=False, colororder='rgb', preamble=[], ffopts=[], pix_fmt=None, crop=None):
+    """
+    Grab the frames showing at `times' (in seconds from the first
+    frame, as in frame_index; or frame numbers, with index=True) into
+    an (N, height, width, 3) array, with a single ffmpeg that decodes
+    the video once and picks the frames out with a select filter,
+    rather than a seek (and an ffmpeg) per time.
+
+    With keyframes=True, only keyframes are decoded (-skip_frame
+    nokey), and each time gets the last keyframe at or before it: much
+    faster, for approximate previews.
 
-        yield arr.reshape((height, width, 3))
+    Times (or numbers) past the end get the last frame.
+    """
+    if index and keyframes:
+        raise ValueError("frames_at can't take frame numbers with keyframes=True")
+    if len(times) == 0:
+        raise ValueError('no times given')
+
+    frame_times, keyframe_idxs = frame_index(path)
+    if len(frame_times) == 0:
+        raise ValueError('%s has no video frames' % (path))
+    if keyframes:
+        # (positions in keyframe_idxs: decoded frames are numbered
+        # from 0 when only keyframes are decoded)
+        frame_times = frame_times[keyframe_idxs]
+    if index:
+        wanted = np.asarray(times, dtype=int)
+    else:
+        wanted = np.searchsorted(frame_times, np.asarray(times, dtype=float), side='right') - 1
+    wanted = np.clip(wanted, 0, len(frame_times) - 1)
+    numbers, positions = np.unique(wanted, return_inverse=True)
+
+    width, height = _infer_size(path, width, height, preamble=preamble, crop=crop)
+    pix_fmt = _reader_pix_fmt(colororder, '24', pix_fmt)
+    if pix_fmt == 'yuv420p':
+        raise ValueError('frames_at needs a packed pix_fmt (not yuv420p)')
+    if keyframes:
+        preamble = ['-skip_frame', 'nokey'] + preamble
+
+    select = '+'.join('eq(n,%d)' % (n) for n in numbers)
+    cmd = _frame_reader_cmd(path, height, width, 0, None, None, colororder, '24', preamble,
+                            ['-vsync', 'passthrough', '-frames:v', str(len(numbers))] + ffopts,
+                            pix_fmt, crop, select)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
+    out = np.empty((len(numbers),) + _frame_shape(width, height, pix_fmt), dtype=np.uint8)
+    out = _read_growing(p, out)
+    if len(out) != len(numbers):
+        # The index doesn't match what ffmpeg decodes, so any frame
+        # past the first missing one would be the wrong one
+        raise RuntimeError('expected %d frames from %s, but ffmpeg returned %d' % (
+            len(numbers), path, len(out)))
+    return out[positions.reshape(-1)]
+
+class VideoReader(object):
+    """
+    Random access to the frames of a video file, by frame number.
+
+        vr = VideoReader(path, width=320)
+        len(vr)     # number of frames
+        vr[100]     # (height, width, 3) array
+        vr[10:20]   # (10, height, width, 3) array
+
+    One ffmpeg process is kept open between reads: reading forward
+    re-uses it as long as there's no keyframe in the way, and anything
+    else seeks (ffmpeg decodes forward from the preceding keyframe).
+    """
+
+    def __init__(self, path, height=None, width=None, colororder='rgb', preamble=[]):
+        self._p = None
+        self._frames = None
+        self._pos = None        # index of the next frame out of self._frames
+
+        self.path = path
+        self.colororder = colororder
+        self.preamble = preamble
+        self.width, self.height = _infer_size(path, width, height, preamble=preamble)
+        self.times, self.keyframes, first_pts = _frame_index(path)
+        # self.times count from the first video frame, but -ss from the
+        # start of the container, which may well be earlier (eg. when
+        # audio starts first)
+        self._start_offset = first_pts - (probe(path, preamble=preamble).start or 0)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idxs = range(*idx.indices(len(self)))
+            out = np.empty((len(idxs), self.height, self.width, 3), dtype=np.uint8)
+            # Read in file order, whatever order was asked for
+            for out_idx, fr_idx in sorted(enumerate(idxs), key=lambda x: x[1]):
+                out[out_idx] = self._read(fr_idx)
+            return out
 
-def video2np(path, **kw):
-    return np.array([X for X in video_frames(path, **kw)])
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("frame index out of range")
+        return self._read(idx).copy()
 
-def frame_writer(width, height, path, fps=30, ffopts=[]):
+    def _keyframe_between(self, start, end):
+        # Is there a keyframe in (start, end]?
+        k_idx = bisect.bisect_right(self.keyframes, start)
+        return k_idx < len(self.keyframes) and self.keyframes[k_idx] <= end
+
+    def _seek(self, idx):
+        self.close()
+
+        start = 0
+        if idx > 0:
+            # Halfway between frames, so that float rounding can't
+            # make ffmpeg drop (or keep) one frame too many.
+            start = max(0, self._start_offset + (self.times[idx-1] + self.times[idx]) / 2.0)
+
+        w, h, self._p = frame_reader(
+            self.path, width=self.width, height=self.height,
+            start=start, fps=None, colororder=self.colororder,
+            preamble=self.preamble, ffopts=['-vsync', 'passthrough'])
+        self._frames = _raw_frames(self._p, (h, w, 3), copy=False)
+        self._pos = idx
+
+    def _read(self, idx):
+        # Returns a view that's only valid until the next read
+        if self._frames is None or idx < self._pos or self._keyframe_between(self._pos, idx):
+            self._seek(idx)
+
+        try:
+            while self._pos < idx:
+                next(self._frames)
+                self._pos += 1
+            fr = next(self._frames)
+        except StopIteration:
+            self.close()
+            raise IndexError("could not decode frame %d" % (idx))
+        self._pos += 1
+        return fr
+
+    def close(self):
+        if self._p is not None:
+            self._p.stdout.close()
+            _kill(self._p)
+        self._p = None
+        self._frames = None
+        self._pos = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+def frame_writer(width, height, path, fps=30, ffopts=[], pix_fmt='rgb24'):
+    # pix_fmt is the layout of the frames you'll write, eg.:
+    #   rgb24, bgr24:   (height, width, 3)
+    #   rgba, bgra:     (height, width, 4)
+    #   gray:           (height, width)
+    #   yuv420p:        (Y, U, V) planes, or one (height*3/2, width) array
+    cmd = _frame_writer_cmd(width, height, path, fps, ffopts, pix_fmt)
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE,stderr=open('/dev/null', 'w'))
+    return p
+
+def _frame_writer_cmd(width, height, path, fps, ffopts, pix_fmt):
     cmd =[get_ffmpeg(), '-y', '-s', '%dx%d' % (width, height),
           '-r', str(fps), 
           '-an',
-          '-pix_fmt', 'rgb24',
+          '-pix_fmt', pix_fmt,
           '-vcodec', 'rawvideo', '-f', 'rawvideo', 
           '-i', '-'] + ffopts + [path]
-    p = subprocess.Popen(cmd, stdin=subprocess.PIPE,stderr=open('/dev/null', 'w'))
-    return p
+    return cmd
+
+def _frame_size(fr, pix_fmt='rgb24'):
+    # (width, height) of a frame laid out as frame_writer expects
+    if isinstance(fr, (tuple, list)):
+        fr = fr[0]
+        return (fr.shape[1], fr.shape[0])
+    if pix_fmt == 'yuv420p':
+        return (fr.shape[1], fr.shape[0] * 2 // 3)
+    return (fr.shape[1], fr.shape[0])
+
+def _write_array(fh, arr):
+    # Writes straight from the array's memory, unless it has to be
+    # made contiguous first. A tuple/list is written plane by plane.
+    if isinstance(arr, (tuple, list)):
+        for plane in arr:
+            _write_array(fh, plane)
+        return
+    fh.write(memoryview(np.ascontiguousarray(arr)).cast('B'))
+
+def _write_stream(p, arrays, writeahead=None):
+    """
+    Write every array to p.stdin, then close it and wait for p.
+
+    With writeahead=k, the writes happen on a background thread, up to
+    k arrays behind the producer, so that generating and encoding
+    overlap. Arrays are queued without a copy: don't modify an array
+    once it's been handed over.
+    """
+    if not writeahead:
+        for arr in arrays:
+            _write_array(p.stdin, arr)
+    else:
+        w = _WriterThread(p.stdin, writeahead)
+        try:
+            for arr in arrays:
+                w.put(arr)
+        finally:
+            w.close()
 
-def frames_to_video(generator, *a, **kw):
-    p = None 
-    for fr in generator:
-        if p is None:
-            p = frame_writer(fr.shape[1], fr.shape[0], *a, **kw)
-        p.stdin.write(fr.tostring())
     p.stdin.close()
-    print('done generating video')
     p.wait()
 
+class _WriterThread(object):
+    # Writes arrays to `fh' on a background thread, through a queue of
+    # up to `writeahead' arrays. Errors surface in put() and close().
+
+    def __init__(self, fh, writeahead):
+        self.fh = fh
+        self.q = queue.Queue(maxsize=writeahead)
+        self.errors = []
+        self.t = threading.Thread(target=self._work)
+        self.t.daemon = True
+        self.t.start()
+
+    def _work(self):
+        while True:
+            arr = self.q.get()
+            if arr is None:
+                return
+            if self.errors:
+                # keep draining, so that the producer can't block
+                continue
+            try:
+                _write_array(self.fh, arr)
+            except Exception as e:
+                self.errors.append(e)
+
+    def put(self, arr):
+        if self.errors:
+            raise self.errors[0]
+        self.q.put(arr)
+
+    def close(self):
+        self.q.put(None)
+        self.t.join()
+        if self.errors:
+            raise self.errors[0]
+
+def frames_to_video(generator, *a, **kw):
+    # writeahead=k encodes on a background thread (see _write_stream)
+    writeahead = kw.pop('writeahead', None)
+    pix_fmt = kw.get('pix_fmt', 'rgb24')
+
+    generator = iter(generator)
+    for fr in generator:
+        width, height = _frame_size(fr, pix_fmt)
+        p = frame_writer(width, height, *a, **kw)
+        _write_stream(p, itertools.chain([fr], generator), writeahead=writeahead)
+        print('done generating video')
+        return
+
 def np2video(np, *a, **kw):
     def vgen():
         for fr in np:
             yield fr
     return frames_to_video(vgen(), *a, **kw)
 
-def sound_chunks(path, chunksize=2048, R=44100, nchannels=2, start=0, duration=None, ffopts=[]):
-    # XXX: endianness EEK
-    # TODO: detect platform endianness & adjust ffmpeg params accordingly
+_SAMPLE_FORMATS = {
+    np.dtype(np.int16): 's16',
+    np.dtype(np.int32): 's32',
+    np.dtype(np.float32): 'f32',
+    np.dtype(np.float64): 'f64'}
+
+def sample_format(dtype):
+    """
+    Return (numpy dtype, ffmpeg sample format) for `dtype', which is
+    either a numpy dtype (int16, int32, float32, float64) or an ffmpeg
+    format name ('s16le', 'f32be', ...). Unless it's spelled out, the
+    byte order is the platform's own.
+    """
+    byteorder = {'little': 'le', 'big': 'be'}[sys.byteorder]
+
+    if isinstance(dtype, str) and dtype[:3] in _SAMPLE_FORMATS.values():
+        if dtype[3:]:
+            byteorder = dtype[3:]
+        for np_dtype, fmt in _SAMPLE_FORMATS.items():
+            if fmt == dtype[:3]:
+                break
+        return (np_dtype.newbyteorder({'le': '<', 'be': '>'}[byteorder]),
+                fmt + byteorder)
+
+    np_dtype = np.dtype(dtype)
+    if np_dtype.newbyteorder('=') not in _SAMPLE_FORMATS:
+        raise ValueError("unsupported sample type: %s" % (dtype))
+    if np_dtype.byteorder in '<>':
+        byteorder = {'<': 'le', '>': 'be'}[np_dtype.byteorder]
+    return (np_dtype, _SAMPLE_FORMATS[np_dtype.newbyteorder('=')] + byteorder)
+
+def chunk_reader(path, R=44100, nchannels=2, start=0, duration=None, ffopts=[], dtype=np.int16):
+    # low-level ffmpeg wrapper
+    # (dtype: see sample_format)
+    cmd = _chunk_reader_cmd(path, R, nchannels, start, duration, ffopts, dtype)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
+    return p
+
+def _chunk_reader_cmd(path, R, nchannels, start, duration, ffopts, dtype):
+    _np_dtype, fmt = sample_format(dtype)
 
     dur_opts = []
     if duration is not None:
@@ -228,48 +1308,116 @@ def sound_chunks(path, chunksize=2048, R=44100, nchannels=2, start=0, duration=N
            '-vn',
            '-ar', str(R), 
            '-ac', str(nchannels), 
-           '-f', 's16le',
-           '-acodec', 'pcm_s16le'] + ffopts + [
+           '-f', fmt,
+           '-acodec', 'pcm_%s' % (fmt)] + ffopts + [
            '-']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
-    frsize = 2*nchannels*chunksize
+    return cmd
 
-    while True:
-        out = np.fromstring(p.stdout.read(frsize), dtype=np.int16).reshape((-1,nchannels))
-        yield out
+def sound_chunks(path, chunksize=2048, R=44100, nchannels=2, start=0, duration=None, ffopts=[], prefetch=None, dtype=np.int16):
+    # prefetch=k reads up to k chunks ahead on a background thread
+    chunks = _sound_chunks(path, chunksize, R=R, nchannels=nchannels, start=start, duration=duration, ffopts=ffopts, dtype=dtype)
+    if prefetch:
+        return prefetched(chunks, prefetch)
+    return chunks
 
-        if len(out) < chunksize:
-            # Make sure the process ends
-            p.wait()
-            return
+def _sound_chunks(path, chunksize, **kw):
+    nchannels = kw['nchannels']
+    np_dtype, _fmt = sample_format(kw['dtype'])
+    p = chunk_reader(path, **kw)
 
-def sound2np(path, **kw):
+    try:
+        while True:
+            out = np.empty((chunksize, nchannels), dtype=np_dtype)
+            nbytes = _readinto(p.stdout, out)
+            out = out[:nbytes // out[0].nbytes]
+            yield out
+
+            if len(out) < chunksize:
+                # Make sure the process ends
+                p.wait()
+                return
+    finally:
+        _kill(p)
+
+def sound2np(path, workers=None, max_bytes=None, **kw):
     """
     Load audio data from a file.
+
+    The array is allocated up front, from the probed duration, and only
+    grows (geometrically) if that estimate turns out to be short. With
+    max_bytes, audio that won't fit raises a MemoryError before
+    decoding starts.
+
+    With workers=N, the duration is split into N ranges that are
+    decoded concurrently, each by its own ffmpeg, straight into one
+    preallocated array.
     """
-    return np.concatenate([x for x in sound_chunks(path, **kw)])
+    args = _bind(chunk_reader, path, **dict([(k, v) for (k, v) in kw.items() if k not in ('chunksize', 'prefetch')]))
+    R = args['R']
+    nchannels = args['nchannels']
+    np_dtype, _fmt = sample_format(args['dtype'])
+
+    duration = args['duration']
+    if duration is None:
+        info = video_info(path)
+        if info["duration"] is not None:
+            duration = info["duration"] - args['start']
+
+    nsamples = None
+    if duration is not None:
+        nsamples = int(duration * R)
+        nbytes = nsamples * nchannels * np_dtype.itemsize
+        if max_bytes is not None and nbytes > max_bytes:
+            raise MemoryError("audio would need %d bytes (max_bytes=%d)" % (nbytes, max_bytes))
+
+    if workers is not None and workers > 1 and nsamples is not None:
+        return _parallel_sound2np(workers, nsamples, **args)
+
+    p = chunk_reader(**args)
+    out = np.empty(((nsamples or R) + R//10, nchannels), dtype=np_dtype)
+    return _read_growing(p, out, max_bytes)
+
+def _parallel_sound2np(workers, nsamples, path, R, nchannels, start, duration, ffopts, dtype):
+    out = np.empty((nsamples, nchannels), dtype=sample_format(dtype)[0])
+
+    def spawn(offset, count):
+        # Ask for a little extra, so that rounding can't leave a gap
+        return chunk_reader(path, R=R, nchannels=nchannels,
+                            start=start + offset / float(R),
+                            duration=(count + R/10.0) / float(R),
+                            ffopts=ffopts, dtype=dtype)
+
+    return _parallel_read(out, _segments(nsamples, workers), spawn)
+
+def chunk_writer(nchannels, path, R=44100, ffopts=[], dtype=np.int16):
+    # (dtype: see sample_format)
+    cmd = _chunk_writer_cmd(nchannels, path, R, ffopts, dtype)
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=open('/dev/null', 'w'))
+    return p
 
-def chunk_writer(nchannels, path, R=44100, ffopts=[]):
+def _chunk_writer_cmd(nchannels, path, R, ffopts, dtype):
+    _np_dtype, fmt = sample_format(dtype)
     cmd =[get_ffmpeg(), '-y',
           '-vn',
           '-ar', str(R),
           '-ac', str(nchannels),
-          '-acodec', 'pcm_s16le',
-          '-f', 's16le',
+          '-acodec', 'pcm_%s' % (fmt),
+          '-f', fmt,
           '-i', '-'] + ffopts + [path]
-    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=open('/dev/null', 'w'))
-    return p
+    return cmd
 
 def chunks_to_sound(generator, *a, **kw):
-    p = None 
+    # writeahead=k encodes on a background thread (see _write_stream)
+    writeahead = kw.pop('writeahead', None)
+
+    generator = iter(generator)
     for ch in generator:
-        if p is None:
-            nchannels = ch.shape[1] if len(ch.shape) > 1 else 1
-            p = chunk_writer(nchannels, *a, **kw)
-        p.stdin.write(ch.tostring())
-    p.stdin.close()
-    print('done generating sound')
-    p.wait()
+        nchannels = ch.shape[1] if len(ch.shape) > 1 else 1
+        kw.setdefault('dtype', ch.dtype)
+        p = chunk_writer(nchannels, *a, **kw)
+        _write_stream(p, itertools.chain([ch], generator), writeahead=writeahead)
+        print('done generating sound')
+        return
 
 def np2sound(np, *a, **kw):
     def agen():
@@ -278,3 +1426,66 @@ def np2sound(np, *a, **kw):
             yield rest[:2048]
             rest = rest[2048:]
     return chunks_to_sound(agen(), *a, **kw)
+
+def av_writer(width, height, nchannels, path, fps=30, R=44100, ffopts=[], pix_fmt='rgb24', dtype=np.int16):
+    """
+    Start one ffmpeg that muxes raw video and raw audio straight into
+    `path'. Write frames to p.stdin and chunks to `audio_fh' (a second
+    pipe, passed to ffmpeg as an extra fd).
+
+    Returns (p, audio_fh).
+    """
+    _np_dtype, fmt = sample_format(dtype)
+    a_r, a_w = os.pipe()
+    cmd = [get_ffmpeg(), '-y',
+           '-f', 'rawvideo', '-vcodec', 'rawvideo',
+           '-s', '%dx%d' % (width, height),
+           '-r', str(fps),
+           '-pix_fmt', pix_fmt,
+           '-i', '-',
+           '-f', fmt,
+           '-ar', str(R),
+           '-ac', str(nchannels),
+           '-i', 'pipe:%d' % (a_r),
+           '-map', '0:v', '-map', '1:a'] + ffopts + [path]
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=open('/dev/null', 'w'), pass_fds=(a_r,))
+    finally:
+        os.close(a_r)
+    return (p, os.fdopen(a_w, 'wb'))
+
+def frames_and_chunks_to_video(generator, path, writeahead=4, **kw):
+    """
+    Encode a generator of (frame, chunk) pairs into one muxed file, in
+    a single ffmpeg pass (see av_writer for options).
+
+    Each stream is written on its own thread, up to `writeahead' items
+    behind the generator, so that ffmpeg never waits on one stream
+    while we're blocked on the other. As with writeahead elsewhere,
+    don't modify frames or chunks once they've been yielded.
+    """
+    generator = iter(generator)
+    for fr, ch in generator:
+        width, height = _frame_size(fr, kw.get('pix_fmt', 'rgb24'))
+        nchannels = ch.shape[1] if len(ch.shape) > 1 else 1
+        kw.setdefault('dtype', ch.dtype)
+        p, audio_fh = av_writer(width, height, nchannels, path, **kw)
+
+        v_w = _WriterThread(p.stdin, writeahead)
+        a_w = _WriterThread(audio_fh, writeahead)
+        try:
+            for fr, ch in itertools.chain([(fr, ch)], generator):
+                # Audio first: it's small, and it means ffmpeg always has
+                # the audio to go with the frame it's waiting for.
+                a_w.put(ch)
+                v_w.put(fr)
+        finally:
+            try:
+                v_w.close()
+                a_w.close()
+            finally:
+                p.stdin.close()
+                audio_fh.close()
+                p.wait()
+        print('done generating video')
+        return
@@ -6,21 +6,310 @@ import numpy as np
 import sdl2
 import sdl2.ext  # Maybe I shouldn't use `ext'?
 
-from . import get_ffmpeg
-from .media import _video_info, webcam_reader
-import subprocess
+from .media import (
+    _kill,
+    _readinto,
+    _video_info,
+    frame_reader,
+    webcam_reader,
+    sample_format,
+    video2np,
+    LatestFrame,
+    LoopedFrames,
+)
+import bisect
+import collections
+import concurrent.futures
+import logging
+import sys
+import threading
+import time
 import traceback
 
-KEYMAP = dict(
-    [(getattr(sdl2, X), X.split("_")[-1]) for X in dir(sdl2) if X.startswith("SDLK_")]
-)
-KEYMODS = dict(
-    [(getattr(sdl2, X), X.split("_")[-1]) for X in dir(sdl2) if X.startswith("KMOD_")]
-)
+log = logging.getLogger(__name__)
+
+_keytables = {}
+
+
+def _keytable(prefix):
+    # {SDLK_a: "a", ...} for prefix "SDLK_"; scanning dir(sdl2) is slow
+    # enough to only do on the first key event
+    if prefix not in _keytables:
+        _keytables[prefix] = dict(
+            [(getattr(sdl2, X), X.split("_")[-1]) for X in dir(sdl2) if X.startswith(prefix)]
+        )
+    return _keytables[prefix]
+
+
+def __getattr__(name):
+    # KEYMAP & KEYMODS, built on demand
+    if name == "KEYMAP":
+        return _keytable("SDLK_")
+    if name == "KEYMODS":
+        return _keytable("KMOD_")
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+# SDL's 32-bit pixel formats, by ffmpeg's name for their byte order
+# in memory: (on little-endian, on big-endian machines)
+_SURFACE_PIX_FMTS = {
+    sdl2.SDL_PIXELFORMAT_ARGB8888: ("bgra", "argb"),
+    sdl2.SDL_PIXELFORMAT_RGB888: ("bgra", "argb"),  # (XRGB8888)
+    sdl2.SDL_PIXELFORMAT_ABGR8888: ("rgba", "abgr"),
+    sdl2.SDL_PIXELFORMAT_BGR888: ("rgba", "abgr"),
+    sdl2.SDL_PIXELFORMAT_RGBA8888: ("abgr", "rgba"),
+    sdl2.SDL_PIXELFORMAT_RGBX8888: ("abgr", "rgba"),
+    sdl2.SDL_PIXELFORMAT_BGRA8888: ("argb", "bgra"),
+    sdl2.SDL_PIXELFORMAT_BGRX8888: ("argb", "bgra"),
+}
+
+
+def _surface_pix_fmt(fmt):
+    if fmt not in _SURFACE_PIX_FMTS:
+        log.warning(
+            "unknown pixel format %s; assuming BGRA", sdl2.SDL_GetPixelFormatName(fmt)
+        )
+        return "bgra"
+    return _SURFACE_PIX_FMTS[fmt][0 if sys.byteorder == "little" else 1]
+
+
+_AUDIO_DTYPES = (np.dtype(np.int16), np.dtype(np.int32), np.dtype(np.float32))
 
 
 def _get_keymods(mod):
-    return dict([(kval, True) for kmod, kval in KEYMODS.items() if mod & kmod])
+    return dict([(kval, True) for kmod, kval in _keytable("KMOD_").items() if mod & kmod])
+
+
+class Stats(object):
+    """
+    Latency histograms (per callback), frame pacing and audio overruns
+    for an ArrayUI(profile=True); see ArrayUI.stats(). With
+    log_interval, a summary is printed every log_interval seconds.
+    """
+
+    # histogram bin edges, in seconds
+    EDGES = [0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.133, 0.266]
+
+    def __init__(self, target_fps=60, log_interval=None):
+        self.target_fps = target_fps
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        self.hists = {}  # name -> [count per bin]
+        self.totals = {}  # name -> [count, total time, max time]
+        self.frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.audio_callbacks = 0
+        self.audio_overruns = 0
+        self.frame_times = collections.deque(maxlen=120)
+        self._start = None
+        self._last_frame = None
+        self._last_log = time.perf_counter()
+
+    def record(self, name, dt):
+        if name not in self.hists:
+            self.hists[name] = [0] * (len(self.EDGES) + 1)
+            self.totals[name] = [0, 0.0, 0.0]
+        self.hists[name][bisect.bisect(self.EDGES, dt)] += 1
+        tot = self.totals[name]
+        tot[0] += 1
+        tot[1] += dt
+        tot[2] = max(tot[2], dt)
+
+    def frame(self):
+        # Call once per presented frame
+        now = time.perf_counter()
+        if self._last_frame is None:
+            self._start = now
+        else:
+            interval = now - self._last_frame
+            self.frame_times.append(interval)
+            period = 1.0 / self.target_fps
+            if interval > 1.5 * period:
+                self.late_frames += 1
+                # ...and it took the slots of this many frames
+                self.dropped_frames += int(interval / period) - 1
+        self._last_frame = now
+        self.frames += 1
+
+        if self.log_interval and now - self._last_log >= self.log_interval:
+            self._last_log = now
+            # (printed, like the rest of nmt's status messages: nmt
+            # doesn't configure logging, so log.info would go nowhere)
+            print(self.summary())
+
+    def audio(self, dt, budget):
+        # One audio callback, which took `dt' of its `budget' seconds
+        self.record("audio_cb", dt)
+        self.audio_callbacks += 1
+        if dt > budget:
+            self.audio_overruns += 1
+
+    def fps(self):
+        "Achieved frame rate, over the last few seconds"
+        if not self.frame_times:
+            return None
+        return len(self.frame_times) / sum(self.frame_times)
+
+    def snapshot(self):
+        callbacks = {}
+        for name, (count, total, max_dt) in self.totals.items():
+            callbacks[name] = {
+                "count": count,
+                "mean": total / count,
+                "max": max_dt,
+                # (upper bin edge, count)
+                "hist": list(zip(self.EDGES + [float("inf")], self.hists[name])),
+            }
+        mean_fps = None
+        if self.frames > 1:
+            mean_fps = (self.frames - 1) / (self._last_frame - self._start)
+        return {
+            "fps": self.fps(),
+            "mean_fps": mean_fps,
+            "target_fps": self.target_fps,
+            "frames": self.frames,
+            "late_frames": self.late_frames,
+            "dropped_frames": self.dropped_frames,
+            "audio_callbacks": self.audio_callbacks,
+            "audio_overruns": self.audio_overruns,
+            "callbacks": callbacks,
+        }
+
+    def summary(self):
+        fps = self.fps()
+        parts = [
+            "fps=%.1f" % (fps or 0),
+            "late=%d" % (self.late_frames),
+            "dropped=%d" % (self.dropped_frames),
+            "audio_overruns=%d" % (self.audio_overruns),
+        ]
+        for name, (count, total, max_dt) in sorted(self.totals.items()):
+            parts.append(
+                "%s=%.1f/%.1fms" % (name, 1000 * total / count, 1000 * max_dt)
+            )
+        return " ".join(parts)
+
+    def draw(self, v, width=120, height=40, colororder="bgr"):
+        """
+        Overlay a graph of recent frame times on the bottom left of `v',
+        an (height, width, 3) view of the colour bytes in `colororder'
+        """
+        height = min(height, v.shape[0])
+        width = min(width, v.shape[1])
+        box = v[v.shape[0] - height :, :width]
+        box //= 4
+
+        times = np.array(self.frame_times)[-width:]
+        period = 1.0 / self.target_fps
+        # Bars are scaled so that the target frame time is half-way up
+        bars = np.minimum(height, (height * times / (2 * period)).astype(int))
+        mask = np.arange(height)[::-1, None] < bars[None, :]
+        red = [0, 0, 255] if colororder == "bgr" else [255, 0, 0]
+        colors = np.where(
+            (times > 1.5 * period)[:, None],
+            np.array(red, dtype=np.uint8),  # late
+            np.array([0, 255, 0], dtype=np.uint8),
+        )
+        cols = box[:, : len(times)]
+        cols[mask] = np.broadcast_to(colors[None], cols.shape)[mask]
+        box[height - height // 2 - 1] = 255
+
+
+class Scheduler(object):
+    """
+    Paces a loop to `fps' frames per second.
+
+    wait() sleeps until the next frame is due, calling pump() every
+    few milliseconds meanwhile (so that input isn't held up), and
+    advance() moves on to the next deadline and returns how many
+    frames' worth of time have passed: always 1 unless `skip' is set,
+    in which case frames that we fell too far behind to show are
+    skipped (and counted in self.skipped).
+    """
+
+    SLICE = 0.002  # seconds between pump()s while waiting
+
+    def __init__(self, fps, skip=False):
+        self.period = 1.0 / fps
+        self.skip = skip
+        self.skipped = 0
+        self.deadline = None
+
+    def wait(self, pump=None):
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        while now < self.deadline:
+            time.sleep(min(self.deadline - now, self.SLICE))
+            if pump is not None:
+                pump()
+            now = time.perf_counter()
+
+    def advance(self):
+        self.deadline += self.period
+        behind = time.perf_counter() - self.deadline
+        if behind <= self.period:
+            return 1
+        # More than a frame behind: don't try to catch up in a burst
+        if self.skip:
+            missed = int(behind / self.period)
+            self.deadline += missed * self.period
+            self.skipped += missed
+            return 1 + missed
+        self.deadline = time.perf_counter()
+        return 1
+
+
+class AudioRing(object):
+    """
+    A ring buffer of audio frames between one producer thread and one
+    consumer thread (eg. the SDL audio callback). There's no lock: each
+    side only ever advances its own counter.
+
+    read_into() fills what it can and zeroes the rest, counting an
+    underrun; write() never overwrites unread audio -- check space()
+    first -- and counts what it has to drop as overruns.
+    """
+
+    def __init__(self, nframes, nchannels, dtype):
+        self.buf = np.zeros((nframes, nchannels), dtype=dtype)
+        self.size = nframes
+        self.written = 0  # frames ever written (producer only)
+        self.nread = 0  # frames ever read (consumer only)
+        self.underruns = 0
+        self.overruns = 0
+
+    def available(self):
+        return self.written - self.nread
+
+    def space(self):
+        return self.size - self.available()
+
+    def write(self, arr):
+        arr = arr.reshape((-1, self.buf.shape[1]))
+        n = min(len(arr), self.space())
+        if n < len(arr):
+            self.overruns += 1
+        start = self.written % self.size
+        first = min(n, self.size - start)
+        self.buf[start : start + first] = arr[:first]
+        self.buf[: n - first] = arr[first:n]
+        self.written += n
+
+    def read_into(self, out):
+        out = out.reshape((-1, self.buf.shape[1]))
+        n = min(len(out), self.available())
+        if n < len(out):
+            self.underruns += 1
+            out[n:] = 0
+        start = self.nread % self.size
+        first = min(n, self.size - start)
+        out[:first] = self.buf[start : start + first]
+        out[first:n] = self.buf[: n - first]
+        self.nread += n
 
 
 class ArrayUI:
@@ -37,6 +326,16 @@ class ArrayUI:
         spoof_mouse=False,
         nowindow=False,
         fullscreen=False,
+        audio_dtype=np.int16,
+        profile=False,
+        profile_overlay=False,
+        profile_log_interval=None,
+        fps=60,
+        vsync=False,
+        frame_skip=False,
+        audio_latency=None,
+        spoof_fps=30,
+        spoof_cache=None,
     ):
         self.size = size
         self.in_size = in_size
@@ -47,7 +346,38 @@ class ArrayUI:
         self.webcam = webcam
         self.spoof_webcam = spoof_webcam
         self.spoof_mouse = spoof_mouse
+        # spoof_webcam is decoded once (into memory, or with spoof_cache
+        # into video2np's on-disk cache) and looped at spoof_fps.
+        self.spoof_fps = spoof_fps
+        self.spoof_cache = spoof_cache
         self.fullscreen = fullscreen
+        # int16, int32 or float32 (in [-1, 1]); see media.sample_format
+        self.audio_dtype = sample_format(audio_dtype)[0]
+        if self.audio_dtype not in _AUDIO_DTYPES:
+            # (what SDL & pyaudio can play, in native byte order)
+            raise ValueError("unsupported audio_dtype: %s" % (audio_dtype))
+        # Target frame rate for run_forever (None: as fast as possible),
+        # optionally synced to the display (vsync) and/or skipping
+        # frames when it can't keep up (self.frame_idx jumps ahead).
+        self.fps = fps
+        self.vsync = vsync
+        self.frame_skip = frame_skip
+        self.frame_idx = 0
+        # With audio_latency (in seconds), audio_out and audio_in run on
+        # their own thread, through ring buffers of about that length;
+        # the SDL callback only copies out of self.audio_ring (and the
+        # mic only copies into self.mic_ring).
+        self.audio_latency = audio_latency
+        self.audio_ring = None
+        self.mic_ring = None
+        self._playback = None
+
+        # Profiling (see stats()) costs nothing but an `is None' per
+        # callback unless it's on.
+        self._stats = None
+        if profile or profile_overlay or profile_log_interval:
+            self._stats = Stats(target_fps=fps or 60, log_interval=profile_log_interval)
+        self.profile_overlay = profile_overlay
 
         if not nowindow:
             if hasattr(self, "video_out"):
@@ -61,6 +391,35 @@ class ArrayUI:
                     self._init_spoof_video_in()
                 else:
                     self._init_video_in()
+            if self.audio_ring is not None or self.mic_ring is not None:
+                t = threading.Thread(target=self._produce_audio)
+                t.daemon = True
+                t.start()
+
+    def _ring_size(self):
+        return max(int(self.audio_latency * self.R), 3 * self.chunksize)
+
+    def _produce_audio(self):
+        # Keeps self.audio_ring full (and self.mic_ring empty)
+        chunk = np.zeros((self.chunksize, self.nchannels), dtype=self.audio_dtype)
+        if self.nchannels == 1:
+            chunk.shape = (-1,)
+        mic_chunk = np.zeros(self.chunksize, dtype=self.audio_dtype)
+        idle = self.chunksize / float(self.R) / 4
+
+        while True:
+            busy = False
+            if self.mic_ring is not None and hasattr(self, "audio_in"):
+                while self.mic_ring.available() >= self.chunksize:
+                    self.mic_ring.read_into(mic_chunk)
+                    self._call("audio_in", self.audio_in, mic_chunk)
+                    busy = True
+            if self.audio_ring is not None and self.audio_ring.space() >= self.chunksize:
+                self._call("audio_out", self.audio_out, chunk)
+                self.audio_ring.write(chunk)
+                busy = True
+            if not busy:
+                time.sleep(idle)
 
     def _init_video(self):
         sdl2.ext.init()
@@ -70,13 +429,63 @@ class ArrayUI:
             flags=(sdl2.SDL_WINDOW_FULLSCREEN_DESKTOP if self.fullscreen else None),
         )
         self._win.show()
-        # TODO: determine (or override?) color-order
-        # on linux, this seems to be BGRA, while on mac it's ARGB
-        self._v = (
-            sdl2.ext.pixels2d(self._win.get_surface())
-            .T.view(np.uint8)
-            .reshape((self.size[1], self.size[0], 4))
+
+        self._renderer = None
+        if self.vsync:
+            self._init_vsync_renderer()
+        if self._renderer is None:
+            surface = self._win.get_surface()
+            self._set_pix_fmt(surface.format.contents.format)
+            self._v = (
+                sdl2.ext.pixels2d(surface)
+                .T.view(np.uint8)
+                .reshape((self.size[1], self.size[0], 4))
+            )
+
+        # video_out gets the three colour channels (in self.colororder,
+        # ie. "bgr" or "rgb"), wherever the fourth byte is
+        if self.pix_fmt in ("argb", "abgr"):
+            self._v3 = self._v[:, :, 1:]
+        else:
+            self._v3 = self._v[:, :, :3]
+
+    def _set_pix_fmt(self, fmt):
+        # self.pix_fmt is the byte order of self._v (see _SURFACE_PIX_FMTS)
+        self.pix_fmt = _surface_pix_fmt(fmt)
+        self.colororder = "rgb" if self.pix_fmt in ("rgba", "argb") else "bgr"
+
+    def _init_vsync_renderer(self):
+        # Window surfaces can't wait for vblank, but renderers can: draw
+        # into our own buffer and present it through a streaming texture.
+        renderer = sdl2.SDL_CreateRenderer(
+            self._win.window,
+            -1,
+            sdl2.SDL_RENDERER_PRESENTVSYNC,
+        )
+        if not renderer:
+            log.info("no vsync renderer (%s)", sdl2.SDL_GetError())
+            return
+        self._renderer = renderer
+        self._set_pix_fmt(sdl2.SDL_PIXELFORMAT_ARGB8888)
+        self._texture = sdl2.SDL_CreateTexture(
+            renderer,
+            sdl2.SDL_PIXELFORMAT_ARGB8888,
+            sdl2.SDL_TEXTUREACCESS_STREAMING,
+            self.size[0],
+            self.size[1],
+        )
+        self._v = np.zeros((self.size[1], self.size[0], 4), dtype=np.uint8)
+
+    def _present(self):
+        if self._renderer is None:
+            self._win.refresh()
+            return
+        sdl2.SDL_UpdateTexture(
+            self._texture, None, self._v.ctypes.data, self._v.strides[0]
         )
+        sdl2.SDL_RenderCopy(self._renderer, self._texture, None, None)
+        # (blocks until vblank)
+        sdl2.SDL_RenderPresent(self._renderer)
 
     def go_fullscreen(self):
         sdl2.SDL_SetWindowFullscreen(
@@ -93,13 +502,28 @@ class ArrayUI:
             print("No mic; ok.")
             return
 
+        stream_kw = {}
+        if self.audio_latency is not None:
+            self.mic_ring = AudioRing(self._ring_size(), 1, self.audio_dtype)
+
+            def on_mic(in_data, frame_count, time_info, status):
+                self.mic_ring.write(np.frombuffer(in_data, dtype=self.audio_dtype))
+                return (None, pyaudio.paContinue)
+
+            stream_kw["stream_callback"] = on_mic
+
         p = pyaudio.PyAudio()
         self._mic = p.open(
-            format=pyaudio.paInt16,
+            format={
+                np.dtype(np.int16): pyaudio.paInt16,
+                np.dtype(np.int32): pyaudio.paInt32,
+                np.dtype(np.float32): pyaudio.paFloat32,
+            }[self.audio_dtype],
             channels=1,
             rate=self.R,
             input=True,
             frames_per_buffer=self.chunksize,
+            **stream_kw
         )
 
     def _init_video_in(self):
@@ -109,59 +533,84 @@ class ArrayUI:
         (w, h, p) = webcam_reader(self.webcam, width=w, height=h)
         self.in_size = (w, h)
         self._v_in = p
+        # Capture on a thread, so that video_in always gets the newest
+        # frame without waiting; see LatestFrame for timestamp & counts.
+        self.capture = LatestFrame(p, (h, w, 3))
 
     def _init_spoof_video_in(self):
-        self._v_in = subprocess.Popen(
-            [
-                get_ffmpeg(),
-                "-i",
-                self.spoof_webcam,  # "-r", "60", (XXX: How to deal with speed?)
-                "-vf",
-                "scale=%d:%d" % (self.in_size[0], self.in_size[1]),
-                "-an",
-                "-vcodec",
-                "rawvideo",
-                "-f",
-                "rawvideo",
-                "-pix_fmt",
-                "bgr24",
-                "-",
-            ],
-            stdout=subprocess.PIPE,
+        w, h = self.in_size
+        frames = video2np(
+            self.spoof_webcam,
+            width=w,
+            height=h,
+            fps=self.spoof_fps,
+            colororder="bgr",
+            cache=self.spoof_cache,
         )
+        self.in_size = (frames.shape[2], frames.shape[1])
+        self.capture = LoopedFrames(frames, fps=self.spoof_fps)
 
     def _next_video_in_fr(self):
-        in_fr = np.fromstring(
-            self._v_in.stdout.read(self.in_size[0] * self.in_size[1] * 3),
-            dtype=np.uint8,
-        )
-        try:
-            in_fr = in_fr.reshape((self.in_size[1], self.in_size[0], 3))
-        except ValueError:
-            if self.spoof_webcam is not None:
-                self._init_spoof_video_in()
-                return self._next_video_in_fr()
-            else:
-                raise
+        in_fr = self.capture.get()
+        if in_fr is None:
+            raise RuntimeError("webcam stopped")
         return in_fr
 
+    def stats(self):
+        "Profiling stats (a dict), or None unless created with profile=True"
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    def _call(self, name, f, *a):
+        # Call f, timing it if we're profiling
+        if self._stats is None:
+            return f(*a)
+        t0 = time.perf_counter()
+        try:
+            return f(*a)
+        finally:
+            self._stats.record(name, time.perf_counter() - t0)
+
     def _handle_audio_cb(self, _udata, cbuf, N):
+        if self._stats is None:
+            return self._fill_audio(cbuf, N)
+
+        t0 = time.perf_counter()
+        self._fill_audio(cbuf, N)
+        budget = N / float(self.audio_dtype.itemsize * self.nchannels * self.R)
+        self._stats.audio(time.perf_counter() - t0, budget)
+
+    def _fill_audio(self, cbuf, N):
+        if self.audio_ring is not None:
+            arr = np.ctypeslib.as_array(cbuf, shape=(N,)).view(self.audio_dtype)
+            self.audio_ring.read_into(arr)
+            return
+
         # Read from mic
         if hasattr(self, "audio_in"):
             if hasattr(self, "_mic"):
-                in_buf = np.fromstring(self._mic.read(self.chunksize), dtype=np.int16)
-                self.audio_in(in_buf)
+                in_buf = np.frombuffer(
+                    self._call("mic", self._mic.read, self.chunksize),
+                    dtype=self.audio_dtype,
+                )
+                self._call("audio_in", self.audio_in, in_buf)
 
         # ...and output
-        arr = np.ctypeslib.as_array(cbuf, shape=(N,)).view(np.int16)
+        arr = np.ctypeslib.as_array(cbuf, shape=(N,)).view(self.audio_dtype)
         if self.nchannels > 1:
             arr.shape = (-1, self.nchannels)
-        self.audio_out(arr)
+        self._call("audio_out", self.audio_out, arr)
 
     def _init_audio(self):
         if sdl2.SDL_InitSubSystem(sdl2.SDL_INIT_AUDIO) != 0:
             raise RuntimeError("Failed to init audio")
 
+        if self.audio_latency is not None:
+            self.audio_ring = AudioRing(
+                self._ring_size(), self.nchannels, self.audio_dtype
+            )
+
         nsamples = self.chunksize * self.nchannels
         # For some reason, on OS X, this is 2x bigger than expected.
         # HACK!
@@ -170,10 +619,16 @@ class ArrayUI:
         if sys.platform == "darwin":
             nsamples = int(nsamples / 2)
 
+        # (native byte order, to match self.audio_dtype)
+        audio_format = {
+            np.dtype(np.int16): sdl2.AUDIO_S16SYS,
+            np.dtype(np.int32): sdl2.AUDIO_S32SYS,
+            np.dtype(np.float32): sdl2.AUDIO_F32SYS,
+        }[self.audio_dtype]
+
         self._audio_spec = sdl2.SDL_AudioSpec(
             self.R,
-            # sdl2.AUDIO_S16MSB,
-            sdl2.AUDIO_S16LSB,  # endianness eek!
+            audio_format,
             self.nchannels,
             nsamples,
             sdl2.SDL_AudioCallback(self._handle_audio_cb),
@@ -187,23 +642,84 @@ class ArrayUI:
         if self.handle_events():
             return True  # Quit
         self._update_av()
+        self.frame_idx += 1
 
     def _update_av(self):
-        # Update visuals
+        self._render_av()
+        self._present_av()
+
+    def _render_av(self):
+        # Everything up to (not including) putting the frame on screen,
+        # which multi_run(threads=...) may run off the main thread.
         if hasattr(self, "video_in"):
             # Read input frame
-            in_fr = self._next_video_in_fr()
-            self.video_in(in_fr)
+            in_fr = self._call("webcam", self._next_video_in_fr)
+            self._call("video_in", self.video_in, in_fr)
 
-        if hasattr(self, "video_out"):
-            self.video_out(self._v[:, :, :3])
-            self._win.refresh()
-        else:
-            # If audio only, slow down loop
-            import time
+        if self._playback is not None:
+            self._call("playback", self._next_playback_fr)
 
+        if hasattr(self, "video_out"):
+            self._call("video_out", self.video_out, self._v3)
+            if self._stats is not None:
+                self._stats.frame()
+                if self.profile_overlay:
+                    self._stats.draw(self._v3, colororder=self.colororder)
+
+    def _present_av(self):
+        if self._drawing():
+            self._call("refresh", self._present)
+        elif self.fps is None:
+            # If audio only, slow down loop (the scheduler does
+            # that otherwise)
             time.sleep(0.1)
 
+    def _drawing(self):
+        return hasattr(self, "video_out") or self._playback is not None
+
+    def play(self, path, loop=False, **kw):
+        """
+        Play a video in the window, decoded by ffmpeg straight into its
+        pixels in their own byte order (self.pix_fmt), so that there's
+        nothing to convert or copy; video_out, if any, draws on top.
+
+        Takes media.frame_reader's arguments (fps defaults to
+        self.fps); with loop=True, ffmpeg repeats the video itself.
+        """
+        if not hasattr(self, "_v"):
+            self._init_video()
+        self.stop()
+
+        preamble = list(kw.pop("preamble", []))
+        if loop:
+            preamble = ["-stream_loop", "-1"] + preamble
+        kw.setdefault("fps", self.fps or 30)
+        _w, _h, self._playback = frame_reader(
+            path,
+            width=self.size[0],
+            height=self.size[1],
+            pix_fmt=self.pix_fmt,
+            preamble=preamble,
+            **kw
+        )
+        # (a surface with padded rows needs a copy after all)
+        self._playback_buf = None
+        if not self._v.flags.c_contiguous:
+            self._playback_buf = np.empty(self._v.shape, dtype=np.uint8)
+
+    def stop(self):
+        "Stop play()ing"
+        if self._playback is not None:
+            _kill(self._playback)
+            self._playback = None
+
+    def _next_playback_fr(self):
+        buf = self._v if self._playback_buf is None else self._playback_buf
+        if _readinto(self._playback.stdout, buf) < buf.nbytes:
+            self.stop()  # EOF
+        elif buf is not self._v:
+            self._v[:] = buf
+
     def handle_events(self):
         # Get all events
         for ev in sdl2.ext.get_events():
@@ -254,26 +770,53 @@ class ArrayUI:
                 # self.keyboard_in("key-press", ev.key.keysym.unicode, ev.key.keysym.mod)
                 self.keyboard_in(
                     "key-press",
-                    KEYMAP[ev.key.keysym.sym],
+                    _keytable("SDLK_")[ev.key.keysym.sym],
                     _get_keymods(ev.key.keysym.mod),
                 )
             if ev.type == sdl2.SDL_KEYUP:
                 self.keyboard_in(
                     "key-release",
-                    KEYMAP[ev.key.keysym.sym],
+                    _keytable("SDLK_")[ev.key.keysym.sym],
                     _get_keymods(ev.key.keysym.mod),
                 )
         # else:
         #     print "unknown event", ev, ev.type
 
+    def _scheduler(self):
+        if self.fps is None:
+            return None
+        fps = self.fps
+        if not self._drawing():
+            # Nothing to draw: just keep up with events
+            fps = min(fps, 10)
+        return Scheduler(fps, skip=self.frame_skip)
+
     def run_forever(self):
         if hasattr(self, "init"):
             self.init()
+        sched = self._scheduler()
+        if sched is None:
+            while True:
+                self.tick()
         while True:
-            self.tick()
-
-
-def multi_run(ns):
+            sched.wait(pump=self.handle_events)
+            self.handle_events()
+            self._update_av()
+            self.frame_idx += sched.advance()
+
+
+def multi_run(ns, threads=None):
+    """
+    Run several ArrayUIs (windows) from one loop.
+
+    By default they take turns on this thread, paced to the fastest
+    window's fps. With threads=N (or True, for one per window), each
+    window instead keeps its own fps and renders -- video_in and
+    video_out -- on a pool of N threads, so that a slow window doesn't
+    hold up the others and numpy-heavy callbacks can use several cores.
+    Events and presentation stay on this thread; callbacks may see
+    mouse_in/keyboard_in while video_out runs.
+    """
     windows_by_id = {}  # winid -> Numm
     for n in ns:
         if hasattr(n, "_win"):
@@ -282,15 +825,77 @@ def multi_run(ns):
         if hasattr(n, "init"):
             n.init()
 
-    while True:
+    def pump():
         for ev in sdl2.ext.get_events():
             if hasattr(ev, "window") and ev.window.windowID in windows_by_id:
                 windows_by_id[ev.window.windowID]._handle_event(ev)
             else:
                 # print "ev not handled by either window", ev, dir(ev)
                 pass
+
+    if threads:
+        return _threaded_multi_run(ns, pump, len(ns) if threads is True else threads)
+
+    # Pace everyone to the fastest window
+    scheds = [n._scheduler() for n in ns]
+    sched = None
+    if ns and None not in scheds:
+        sched = min(scheds, key=lambda s: s.period)
+
+    while True:
+        if sched is not None:
+            sched.wait(pump=pump)
+        pump()
         for n in ns:
             n._update_av()
+        step = sched.advance() if sched is not None else 1
+        for n in ns:
+            n.frame_idx += step
+
+
+def _threaded_multi_run(ns, pump, threads):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    scheds = [n._scheduler() for n in ns]
+    pending = {}  # index in ns -> future of its _render_av
+
+    try:
+        while True:
+            pump()
+            now = time.perf_counter()
+            for i, n in enumerate(ns):
+                fut = pending.get(i)
+                if fut is not None:
+                    if not fut.done():
+                        continue
+                    # Rendered: show it, and on to the next frame
+                    del pending[i]
+                    fut.result()
+                    n._present_av()
+                    n.frame_idx += scheds[i].advance() if scheds[i] else 1
+                sched = scheds[i]
+                if sched is not None:
+                    if sched.deadline is None:
+                        sched.deadline = now
+                    if now < sched.deadline:
+                        continue
+                pending[i] = pool.submit(n._render_av)
+
+            # Wait for a render to finish or the next deadline, but no
+            # more than a few ms, so that events keep flowing
+            due = [s.deadline for i, s in enumerate(scheds) if s and i not in pending]
+            timeout = Scheduler.SLICE
+            if due:
+                timeout = min(max(min(due) - time.perf_counter(), 0), timeout)
+            if pending:
+                concurrent.futures.wait(
+                    list(pending.values()),
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+            else:
+                time.sleep(timeout)
+    finally:
+        pool.shutdown(wait=True)
 
 
 class HotPluggableUI(ArrayUI):
@@ -298,6 +903,20 @@ class HotPluggableUI(ArrayUI):
         self.cbs = {}
         ArrayUI.__init__(self, *a, **kw)
 
+    def swap_cbs(self, cbs):
+        # Replace all of self.cbs at once, before the next frame (or
+        # right away if we're not drawing frames)
+        if hasattr(self, "_v"):
+            self._next_cbs = cbs
+        else:
+            self.cbs = cbs
+
+    def _render_av(self):
+        cbs = self.__dict__.pop("_next_cbs", None)
+        if cbs is not None:
+            self.cbs = cbs
+        ArrayUI._render_av(self)
+
     def _do_thing(self, name, *a):
         if name in self.cbs:
             try:
@@ -6,14 +6,15 @@ from __future__ import absolute_import
 from . import get_ffmpeg
 from . import media
 from . import mediate
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 
+import multiprocessing
 import numpy as np
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import traceback
 
 
@@ -24,10 +25,22 @@ def _load_module(path, g={}):
     return g
 
 
-class Ev2CB(FileSystemEventHandler):
+def _observer():
+    # (watchdog is only imported once something is being watched)
+    from watchdog.observers import Observer
+
+    return Observer()
+
+
+class Ev2CB(object):
+    # A watchdog event handler (all it needs is dispatch())
     def __init__(self, pathmap):
         self.pathmap = pathmap  # {path: cb}
-        FileSystemEventHandler.__init__(self)
+
+    def dispatch(self, ev):
+        handler = getattr(self, "on_%s" % (ev.event_type), None)
+        if handler is not None:
+            handler(ev)
 
     def get_cb(self, ev):
         print("get_cb", ev.src_path, ev)
@@ -64,30 +77,118 @@ def print_errors(f):
 
 
 def _monitor_changes(path, cb):
-    obs = Observer()
+    obs = _observer()
     e2cb = Ev2CB({path: cb})
     obs.schedule(e2cb, os.path.dirname(os.path.abspath(path)))
     obs.start()
     return obs
 
 
-def run(path, g={}, **kw):
-    run = mediate.HotPluggableUI(**kw)
+DEBOUNCE = 0.25  # seconds of quiet after a change before reloading
+
+
+class Persistent(object):
+    """
+    Scripts get one of these as `persist', for globals that are too
+    expensive to recompute on every reload:
+
+        arr = persist("arr", video2np, "in.mp4", width=320)
+
+    calls video2np(...) on the first load, and returns the same array
+    on later ones (unless the arguments have changed).
+    """
+
+    def __init__(self):
+        self._values = {}  # name -> (args, value)
+
+    def __call__(self, name, f, *a, **kw):
+        args = repr((a, sorted(kw.items())))
+        if name in self._values and self._values[name][0] == args:
+            return self._values[name][1]
+        value = f(*a, **kw)
+        self._values[name] = (args, value)
+        return value
+
+
+class Reloader(object):
+    """
+    Loads a script into a HotPluggableUI, and reloads it (changed()) on
+    a background thread once its file has been quiet for `delay'
+    seconds, so that an editor's burst of events on save costs a single
+    reload and the UI never waits on one.
+
+    The first load runs in `g' itself, as the script's globals (so
+    run(path, globals()) shares the caller's namespace). Each reload
+    runs in a copy of the previous globals, so module-level state
+    carries over (and callbacks still running keep seeing a consistent
+    namespace) -- but from then on, changes no longer reach the
+    caller's `g'. The new callbacks are swapped in all at once,
+    between frames.
+
+    Loads run one at a time, and a load that a newer change has
+    overtaken is dropped rather than swapped in.
+    """
+
+    def __init__(self, ui, path, g, delay=DEBOUNCE):
+        self.ui = ui
+        self.path = path
+        self.g = g
+        self.delay = delay
+        self.persist = Persistent()
+        self._loaded = False
+        self._timer = None
+        self._changes = 0  # bumped by every changed()
+        self._lock = threading.Lock()  # guards _timer & _changes
+        self._load_lock = threading.Lock()  # one load() at a time
+
+    def load(self):
+        with self._load_lock:
+            changes = self._changes
+            print("load!", self.path)
+            g = dict(self.g) if self._loaded else self.g
+            g["self"] = self.ui
+            g["persist"] = self.persist
+            try:
+                _load_module(self.path, g=g)
+            except Exception:
+                traceback.print_exc()
+                return False
+
+            if self._changes != changes:
+                # The file changed again meanwhile: its reload is due
+                print("stale load of %s; skipping" % (self.path))
+                return False
+            self.g = g
+            self._loaded = True
+            self.ui.swap_cbs(dict((k, print_errors(v)) for k, v in g.items()))
+            return True
+
+    def changed(self):
+        with self._lock:
+            self._changes += 1
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.load)
+            self._timer.daemon = True
+            self._timer.start()
 
-    def load():
-        print("load!")
-        g["self"] = run
-        try:
-            module = _load_module(path, g=g)
-        except Exception:
-            traceback.print_exc()
-            return
 
-        for k, v in module.items():
-            run.cbs[k] = print_errors(v)
+def onload(run, path, g):
+    "A function that (re)loads the script at `path' into `run'"
+    return Reloader(run, path, g).load
 
-    load()
-    obs = _monitor_changes(path, load)
+
+def run(path, g={}, **kw):
+    """
+    Run the script at `path' in a HotPluggableUI, reloading it whenever
+    it changes (see Reloader). It first runs in `g' itself; reloads
+    run in a copy of the script's globals.
+    """
+    run = mediate.HotPluggableUI(**kw)
+    reloader = Reloader(run, path, g)
+    reloader.load()
+
+    obs = _monitor_changes(path, reloader.changed)
     try:
         run.run_forever()
     except KeyboardInterrupt:
@@ -97,19 +198,13 @@ def run(path, g={}, **kw):
     obs.join()
 
 
-def onload(run, path, g):
-    def load():
-        print("load!", path)
-        g["self"] = run
-        module = _load_module(path, g=g)
-        for k, v in module.items():
-            run.cbs[k] = print_errors(v)
-
-    return load
-
-
-def multi_run(ns):
-    "ns is a sequence of (path, g, kw) tuples"
+def multi_run(ns, threads=None):
+    """
+    ns is a sequence of (path, g, kw) tuples; see mediate.multi_run for
+    `threads'. As with run(), each script first runs in its `g', but
+    reloads run in a copy: entries given the same `g' share state until
+    one of them is reloaded.
+    """
 
     cbs = {}  # path -> cb
     uis = []
@@ -119,10 +214,11 @@ def multi_run(ns):
         run = mediate.HotPluggableUI(**kwarg)
         uis.append(run)
 
-        cbs[path] = onload(run, path, g)
-        cbs[path]()
+        reloader = Reloader(run, path, g)
+        reloader.load()
+        cbs[path] = reloader.changed
 
-    obs = Observer()
+    obs = _observer()
     e2cb = Ev2CB(cbs)
     dirpath = os.path.dirname(os.path.abspath(list(cbs.keys())[0]))
     print("dirpath", dirpath)
@@ -130,7 +226,7 @@ def multi_run(ns):
     obs.start()
 
     try:
-        mediate.multi_run(uis)
+        mediate.multi_run(uis, threads=threads)
     except KeyboardInterrupt:
         print("interrupt...")
     finally:
@@ -142,19 +238,64 @@ def multi_run_static(ns):
     # don't track, but use same semantics
     uis = []
     for (path, g, kwarg) in ns:
-        run = media.HotPluggableUI(**kwarg)
+        run = mediate.HotPluggableUI(**kwarg)
         uis.append(run)
-        onload(run, path, g)()
+        Reloader(run, path, g).load()
     mediate.multi_run(uis)
 
 
-def render(path, out_path, duration, g={}, fps=30, R=44100, **kw):
+def render(path, out_path, duration, g={}, fps=30, R=44100, mux=True, workers=None, batch=16, **kw):
+    """
+    Render a script offline, to a video file.
+
+    With mux=True (the default), video and audio go straight into one
+    ffmpeg that writes `out_path'. With mux=False, they're encoded to
+    temporary files, which a third ffmpeg then merges.
+
+    While rendering, self.frame_idx is the index of the frame being
+    drawn. A script whose output depends only on that (and not on
+    state carried over from earlier frames) can declare
+
+        shardable = True
+
+    and then workers=N renders N stretches of the timeline in parallel,
+    each in its own process (which loads the script afresh), and joins
+    them with ffmpeg's concat demuxer. (Shards keep their audio as raw
+    PCM, which is joined and encoded once, so that there are no AAC
+    seams.)
+
+    A script may define video_out_batch(frames, t0) and/or
+    audio_out_batch(chunks, t0) in place of video_out and audio_out, to
+    fill `batch' frames (an (N, height, width, 3) block) or chunks at a
+    time, starting at time t0 (in seconds). Blocks are zeroed and
+    re-used from batch to batch.
+    """
+    run = _render_ui(path, g, fps, R, kw)
+    nframes = int(duration * fps)
+
+    if workers is not None and workers > 1:
+        if g.get("shardable"):
+            return _render_sharded(
+                run, path, out_path, nframes, g, fps, R, workers, batch, kw
+            )
+        print("%s isn't shardable; rendering sequentially" % (path))
+
+    _render(run, out_path, 0, nframes, fps, R, mux, batch)
+
+
+def _render_ui(path, g, fps, R, kw):
+    kw = dict(kw)
     kw["nowindow"] = True
+    kw["fps"] = fps  # (self.fps, for scripts that keep time by it)
+    kw["R"] = R
 
     run = mediate.HotPluggableUI(**kw)
 
     def load():
         g["self"] = run
+        g["persist"] = Persistent()
+        # (only the script itself can declare itself shardable)
+        g.pop("shardable", None)
         try:
             module = _load_module(path, g=g)
         except Exception:
@@ -165,34 +306,196 @@ def render(path, out_path, duration, g={}, fps=30, R=44100, **kw):
             run.cbs[k] = print_errors(v)
 
     load()
+    return run
 
-    FPS = fps
-    CHUNK_LEN = R / FPS  # XXX: integer assert?
-    audio_chunks = []
-    nframes = int(duration * FPS)
 
-    v_frame_writer = None
-    a_frame_writer = None
+def _render_sharded(run, path, out_path, nframes, g, fps, R, workers, batch, kw):
+    # (fork, so that `g' needn't be picklable)
+    ctx = multiprocessing.get_context("fork")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shard_paths = []
+        pcm_paths = []
+        procs = []
+        for shard_idx, (start_idx, count) in enumerate(media._segments(nframes, workers)):
+            shard_path = os.path.join(
+                tmpdir, "shard-%04d.%s" % (shard_idx, out_path.split(".")[-1])
+            )
+            pcm_path = os.path.join(tmpdir, "shard-%04d.pcm" % (shard_idx))
+            shard_paths.append(shard_path)
+            pcm_paths.append(pcm_path)
+            procs.append(
+                ctx.Process(
+                    target=_render_shard,
+                    args=(path, shard_path, pcm_path, start_idx, count, g, fps, R, batch, kw),
+                )
+            )
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        if any([p.exitcode != 0 for p in procs]):
+            raise RuntimeError("rendering a shard failed")
+
+        list_path = os.path.join(tmpdir, "shards.txt")
+        with open(list_path, "w") as fh:
+            for shard_path in shard_paths:
+                fh.write("file '%s'\n" % (shard_path))
+
+        # Raw PCM joins seamlessly: just append it
+        audio_path = os.path.join(tmpdir, "audio.pcm")
+        with open(audio_path, "wb") as out_fh:
+            for pcm_path in pcm_paths:
+                with open(pcm_path, "rb") as in_fh:
+                    shutil.copyfileobj(in_fh, out_fh)
+        _np_dtype, fmt = media.sample_format(run.audio_dtype)
+
+        subprocess.check_call(
+            [
+                get_ffmpeg(),
+                "-y",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_path,
+                "-f",
+                fmt,
+                "-ar",
+                str(R),
+                "-ac",
+                str(run.nchannels),
+                "-i",
+                audio_path,
+                "-map",
+                "0:v",
+                "-map",
+                "1:a",
+                "-c:v",
+                "copy",
+                "-strict",
+                "-2",
+                "-b:a",
+                "192k",
+                "-movflags",
+                "faststart",  # XXX: will this break on non-mp4's?
+                out_path,
+            ]
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _render_shard(path, out_path, pcm_path, start_idx, nframes, g, fps, R, batch, kw):
+    run = _render_ui(path, dict(g), fps, R, kw)
+    _render(run, out_path, start_idx, nframes, fps, R, False, batch, pcm_path=pcm_path)
 
-    with tempfile.NamedTemporaryFile(suffix=".%s" % (out_path.split(".")[-1])) as v_fh:
-        with tempfile.NamedTemporaryFile(suffix=".wav") as a_fh:
 
-            for idx in range(nframes):
-                v_fr = np.zeros((run.size[1], run.size[0], 3), dtype=np.uint8)
-                a_fr = np.zeros((CHUNK_LEN, 2), dtype=np.int16)
+WRITEAHEAD = 4  # frames queued for the encoder, per stream
 
-                if v_frame_writer is None:
-                    v_frame_writer = media.frame_writer(
-                        v_fr, v_fh.name, fps=FPS, ffopts=["-pix_fmt", "yuv420p"]
-                    )
-                if a_frame_writer is None:
-                    a_frame_writer = media.chunk_writer(a_fr, a_fh.name, R=R)
 
-                run.video_out(v_fr)
-                run.audio_out(a_fr)
+def _render(run, out_path, start_idx, nframes, fps, R, mux, batch, pcm_path=None):
+    # (with pcm_path, out_path gets only the video, and pcm_path the
+    # audio as raw samples)
+    FPS = fps
+    CHUNK_LEN = int(R / FPS)  # XXX: integer assert?
+
+    if "video_out_batch" not in run.cbs and "audio_out_batch" not in run.cbs:
+        batch = 1
+    # A block can be re-used once the encoder has been handed WRITEAHEAD
+    # (+1 in flight) newer frames.
+    nblocks = -(-(WRITEAHEAD + 1) // batch) + 1
+    v_blocks = [
+        np.zeros((batch, run.size[1], run.size[0], 3), dtype=np.uint8)
+        for _ in range(nblocks)
+    ]
+    a_blocks = [
+        np.zeros((batch, CHUNK_LEN, run.nchannels), dtype=run.audio_dtype)
+        for _ in range(nblocks)
+    ]
+
+    def av_frames():
+        for block_idx, idx in enumerate(range(start_idx, start_idx + nframes, batch)):
+            n = min(batch, start_idx + nframes - idx)
+            v_frs = v_blocks[block_idx % nblocks][:n]
+            a_frs = a_blocks[block_idx % nblocks][:n]
+            v_frs[:] = 0
+            a_frs[:] = 0
+
+            run.frame_idx = idx
+            if not run._do_thing("video_out_batch", v_frs, idx / float(FPS)):
+                for i in range(n):
+                    run.frame_idx = idx + i
+                    run.video_out(v_frs[i])
+
+            run.frame_idx = idx
+            if not run._do_thing("audio_out_batch", a_frs, idx / float(FPS)):
+                for i in range(n):
+                    run.frame_idx = idx + i
+                    run.audio_out(a_frs[i])
+
+            for i in range(n):
+                yield (v_frs[i], a_frs[i])
+
+    # video_out draws BGR (as on screen)
+    if mux:
+        media.frames_and_chunks_to_video(
+            av_frames(),
+            out_path,
+            writeahead=WRITEAHEAD,
+            fps=FPS,
+            R=R,
+            pix_fmt="bgr24",
+            ffopts=[
+                "-pix_fmt",
+                "yuv420p",
+                "-strict",
+                "-2",
+                "-b:a",
+                "192k",
+                "-movflags",
+                "faststart",  # XXX: will this break on non-mp4's?
+            ],
+        )
+        return
+
+    if pcm_path is not None:
+        v_frame_writer = media.frame_writer(
+            run.size[0],
+            run.size[1],
+            out_path,
+            fps=FPS,
+            ffopts=["-pix_fmt", "yuv420p"],
+            pix_fmt="bgr24",
+        )
+        with open(pcm_path, "wb") as a_fh:
+            for (v_fr, a_fr) in av_frames():
+                media._write_array(v_frame_writer.stdin, v_fr)
+                media._write_array(a_fh, a_fr)
+        v_frame_writer.stdin.close()
+        if v_frame_writer.wait() != 0:
+            raise RuntimeError("encoding %s failed" % (out_path))
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".%s" % (out_path.split(".")[-1])) as v_fh:
+        with tempfile.NamedTemporaryFile(suffix=".wav") as a_fh:
+
+            v_frame_writer = media.frame_writer(
+                run.size[0],
+                run.size[1],
+                v_fh.name,
+                fps=FPS,
+                ffopts=["-pix_fmt", "yuv420p"],
+                pix_fmt="bgr24",
+            )
+            a_frame_writer = media.chunk_writer(
+                run.nchannels, a_fh.name, R=R, dtype=run.audio_dtype
+            )
 
-                v_frame_writer.stdin.write(v_fr[:, :, (2, 1, 0)].tostring())
-                a_frame_writer.stdin.write(a_fr.tostring())
+            for (v_fr, a_fr) in av_frames():
+                media._write_array(v_frame_writer.stdin, v_fr)
+                media._write_array(a_frame_writer.stdin, a_fr)
 
             v_frame_writer.stdin.close()
             a_frame_writer.stdin.close()